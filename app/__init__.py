@@ -11,20 +11,33 @@ import random
 from flask import Flask
 from flask_bootstrap import Bootstrap
 
-from . import fonts
+from . import fonts, metrics
+from .cache import LRUCache
+from .coalescing import PreviewCoalescer
+from .uploads import Uploads
+from .label_templates import LabelTemplates
+from .raster_spool import RasterSpool
+from .jobs import PrintJobs, create_render_executor
 from config import Config
 
 bootstrap = Bootstrap()
 
 
-def create_app(config_class=Config):
+def create_app(config_class=Config, preload=False):
+    """
+    :param preload: the app is loaded before the server forks its workers
+        (gunicorn preload_app). The fonts are refreshed right away instead of
+        in a background thread, the render pool is created by every worker on
+        its first print job (see RenderExecutor)
+    """
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_object(config_class)
     app.config.from_pyfile('application.py', silent=True)
 
     app.logger.setLevel(app.config['LOG_LEVEL'])
 
-    main(app)
+    init_globals(app, preload)
+    metrics.init_app(app)
 
     app.config['BOOTSTRAP_SERVE_LOCAL'] = True
     bootstrap.init_app(app)
@@ -41,13 +54,31 @@ def create_app(config_class=Config):
     return app
 
 
-def main(app):
-    global FONTS
-
-    FONTS = fonts.Fonts()
-    FONTS.scan_global_fonts()
-    if app.config['FONT_FOLDER']:
-        FONTS.scan_fonts_folder(app.config['FONT_FOLDER'])
+def init_globals(app, preload=False):
+    global FONTS, PREVIEW_CACHE, PREVIEW_COALESCER, PRINT_JOBS, UPLOADS, LABEL_TEMPLATES, RASTER_SPOOL
+
+    # entries are (preview, label size)
+    PREVIEW_CACHE = LRUCache(app.config['PREVIEW_CACHE_SIZE'], sizeof=lambda entry: len(entry[0]))
+    PREVIEW_COALESCER = PreviewCoalescer()
+    UPLOADS = Uploads(
+        app.config['UPLOAD_CACHE_SIZE'],
+        app.config['UPLOAD_BITMAP_CACHE_SIZE'],
+        app.config['UPLOAD_FOLDER'],
+        app.config['UPLOAD_FOLDER_SIZE'])
+    LABEL_TEMPLATES = LabelTemplates(app.config['LABEL_TEMPLATE_FOLDER'])
+    RASTER_SPOOL = RasterSpool(app.config['RASTER_SPOOL_FOLDER'])
+    PRINT_JOBS = PrintJobs(
+        app.config['PRINT_JOB_HISTORY'],
+        create_render_executor(app.config),
+        app.config['RENDER_PREFETCH'])
+
+    FONTS = fonts.Fonts(
+        index_path=app.config['FONT_INDEX'],
+        directories=app.config['FONT_DIRECTORIES'],
+        folder=app.config['FONT_FOLDER'])
+    # a thread holding the lock of the fonts while the workers are forked
+    # would leave it locked in the workers, refresh the index before
+    FONTS.load(background=not preload)
 
     if not FONTS.fonts_available():
         app.logger.error(
@@ -67,3 +98,8 @@ def main(app):
         app.config['LABEL_DEFAULT_FONT_STYLE'] = style
         app.logger.warn(
             'The default font is now set to: {} ({})\n'.format(family, style))
+
+    fonts.FONT_POOL.resize(app.config['FONT_POOL_SIZE'])
+    fonts.FONT_POOL.preload(
+        FONTS.fonts[app.config['LABEL_DEFAULT_FONT_FAMILY']][app.config['LABEL_DEFAULT_FONT_STYLE']],
+        app.config['FONT_PRELOAD_SIZES'])
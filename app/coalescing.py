@@ -0,0 +1,99 @@
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+CLIENT_ID_PATTERN = re.compile(r'[\w\-]{1,64}')
+
+
+class Superseded(Exception):
+    """ A newer preview of the same client arrived, the render is abandoned """
+
+
+class PreviewClient:
+    def __init__(self):
+        self.latest = 0
+        # renders of one client run one after the other
+        self.lock = threading.Lock()
+
+
+class Render:
+    """ Render of a preview request, checked between its stages """
+
+    def __init__(self, client, seq):
+        self._client = client
+        self._seq = seq
+
+    def check(self):
+        """ :raises Superseded: if a newer preview of the client arrived """
+        if self._client is not None and self._seq < self._client.latest:
+            raise Superseded()
+
+
+class PreviewCoalescer:
+    """ Tracks the latest preview sequence number per client (a browser tab),
+    so renders for input which was changed in the meantime are skipped
+    instead of competing with the render of the current input.
+    """
+
+    def __init__(self, max_clients=1024):
+        """
+        :param max_clients: number of clients tracked, the least recently seen are dropped
+        """
+        self.max_clients = max_clients
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self.renders = 0
+        self.superseded = 0
+
+    def register(self, client_id=None, seq=None):
+        """ Records the sequence number of a preview as soon as it arrives, also
+        if it is answered from the cache
+        :return: the client or None for requests without (valid) client_id or seq
+        """
+        if not client_id or seq is None or not CLIENT_ID_PATTERN.fullmatch(client_id):
+            return None
+        with self._lock:
+            client = self._clients.get(client_id)
+            if client is None:
+                client = self._clients[client_id] = PreviewClient()
+                while len(self._clients) > self.max_clients:
+                    self._clients.popitem(last=False)
+            self._clients.move_to_end(client_id)
+            client.latest = max(client.latest, seq)
+            return client
+
+    @contextmanager
+    def render(self, client_id=None, seq=None):
+        """ Waits for running renders of the client, requests without client_id
+        or seq are never superseded
+        :raises Superseded: if a newer preview of the client arrived in the meantime
+        """
+        client = self.register(client_id, seq)
+        if client is None:
+            self._count('renders')
+            yield Render(None, seq)
+            return
+
+        with client.lock:
+            render = Render(client, seq)
+            try:
+                render.check()
+                self._count('renders')
+                yield render
+            except Superseded:
+                self._count('superseded')
+                raise
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self):
+        with self._lock:
+            clients = len(self._clients)
+        return {
+            'clients': clients,
+            'renders': self.renders,
+            'superseded': self.superseded
+        }
@@ -1,11 +1,34 @@
+import os
+import json
+import logging
 import subprocess
 import sys
+import threading
 from collections import defaultdict
 
+from PIL import ImageFont
+
+from .cache import LRUCache
+from .metrics import stage
+
+
+logger = logging.getLogger(__name__)
+
 
 class Fonts:
-    def __init__(self):
+    def __init__(self, index_path='', directories=(), folder=''):
+        """
+        :param index_path: JSON file to persist the found fonts, empty to disable
+        :param directories: font directories whose modification times invalidate the index
+        :param folder: additional font folder which is scanned with fc-scan
+        """
         self.fonts = defaultdict(dict)
+        self.index_path = index_path
+        self.directories = [os.path.expanduser(directory) for directory in directories]
+        self.folder = folder
+        if folder:
+            self.directories.append(folder)
+        self._lock = threading.Lock()
 
     def parse_fonts(self, raw):
         """ adds the found fonts the the fonts list
@@ -61,6 +84,116 @@ class Fonts:
 
         self.parse_fonts(raw)
 
+    def scan_files(self, files):
+        """ adds the fonts of the given font files """
+        cmd = ['fc-scan', '--format',
+               '%{file}:%{family}:style=%{style}\n'] + files
+        try:
+            raw = subprocess.run(cmd, stdout=subprocess.PIPE)
+        except FileNotFoundError:
+            print('fc-scan not found', file=sys.stderr)
+            sys.exit(2)
+
+        self.parse_fonts(raw)
+
+    def scan(self):
+        """ Scans all fonts from scratch and updates the index """
+        with self._lock:
+            found = Fonts()
+            found.scan_global_fonts()
+            if self.folder:
+                found.scan_fonts_folder(self.folder)
+            self.fonts = found.fonts
+            self.save_index(self.directory_signature())
+
+    def directory_signature(self):
+        """ Modification times of all (sub)directories of the font directories
+        :return: dict mapping directory to mtime
+        """
+        signature = {}
+        for directory in self.directories:
+            for root, dirs, files in os.walk(directory):
+                try:
+                    signature[root] = os.stat(root).st_mtime
+                except OSError:
+                    pass
+        return signature
+
+    def load_index(self):
+        """ Loads the fonts found by a previous run
+        :return: the directory signature stored with the fonts, None if there is no usable index
+        """
+        if not self.index_path:
+            return None
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                index = json.load(f)
+            fonts = defaultdict(dict, index['fonts'])
+            signature = index['signature']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        self.fonts = fonts
+        return signature
+
+    def save_index(self, signature):
+        if not self.index_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'signature': signature, 'fonts': self.fonts}, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.warning('Could not save the font index %s: %s', self.index_path, e)
+
+    def refresh_index(self, signature):
+        """ Rescans only the directories which changed since the index was saved
+        :param signature: the directory signature stored in the index
+        :return: True if fonts were updated
+        """
+        with self._lock:
+            current = self.directory_signature()
+            changed = [directory for directory in set(signature) | set(current)
+                       if signature.get(directory) != current.get(directory)]
+            if not changed:
+                return False
+
+            found = Fonts()
+            for family, styles in self.fonts.items():
+                for style, path in styles.items():
+                    if os.path.dirname(path) not in changed:
+                        found.fonts[family][style] = path
+
+            for directory in changed:
+                if directory not in current:
+                    continue
+                files = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                         if name.lower().endswith(('.ttf', '.otf'))]
+                if files:
+                    found.scan_files(files)
+
+            self.fonts = found.fonts
+            self.save_index(current)
+            logger.info('Rescanned %d changed font directories', len(changed))
+            return True
+
+    def load(self, background=True):
+        """ Loads the fonts from the index and refreshes it in the background,
+        or scans all fonts if there is no index yet
+        :param background: False refreshes the index before returning, e.g. if
+            the process forks afterwards
+        """
+        signature = self.load_index()
+        if signature is None or not self.fonts_available():
+            self.scan()
+        elif not background:
+            self.refresh_index(signature)
+        else:
+            threading.Thread(
+                target=self.refresh_index, args=(signature,),
+                name='font-index', daemon=True).start()
+
     def fontlist(self):
         return sorted(self.fonts, key=str.lower)
 
@@ -69,3 +202,46 @@ class Fonts:
             return False
         else:
             return len(self.fonts)
+
+
+def font_mtime(path):
+    """ :return: modification time of the font file, part of the cache keys
+        so a font replaced at the same path is loaded again
+    """
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class FontPool:
+    """ Process wide pool of loaded fonts, so a font file is only parsed once
+    for every combination of path, size and face index (and again once it
+    was replaced)
+    """
+
+    def __init__(self, max_fonts=32):
+        self._cache = LRUCache(max_fonts, sizeof=lambda font: 1)
+
+    def get(self, path, size, index=0):
+        key = (path, font_mtime(path), size, index)
+        font = self._cache.get(key)
+        if font is None:
+            with stage('font_load'):
+                font = ImageFont.truetype(path, size, index=index)
+            self._cache.set(key, font)
+        return font
+
+    def preload(self, path, sizes):
+        for size in sizes:
+            self.get(path, size)
+
+    def resize(self, max_fonts):
+        self._cache.max_size = max_fonts
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+FONT_POOL = FontPool()
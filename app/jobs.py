@@ -0,0 +1,471 @@
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import BrokenExecutor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from enum import Enum
+
+logger = logging.getLogger(__name__)
+
+
+def create_render_executor(config):
+    """ Creates the executor which renders and rasterizes the labels of a
+    print job in parallel
+    :param config: the app config
+    :return: a RenderExecutor if RENDER_PROCESSES is set or RENDER_THREADS is
+        larger than one, None otherwise
+    """
+    if config['RENDER_PROCESSES'] > 0 or config['RENDER_THREADS'] > 1:
+        return RenderExecutor(config)
+    return None
+
+
+class RenderExecutor:
+    """ Process or thread pool rendering the labels, created on first use in
+    every process. A pool created before the server forks its workers would
+    share its queues and pipes with all of them.
+
+    A pool broken by a dying render process (e.g. killed for its memory) is
+    replaced and the labels it was rendering are rendered once more. If no
+    new pool can be created, the labels are rendered in the calling thread.
+    """
+
+    def __init__(self, config):
+        """
+        :param config: the app config
+        """
+        self._processes = config['RENDER_PROCESSES']
+        self._threads = config['RENDER_THREADS']
+        self._process_config = {key: value for key, value in config.items() if key.isupper()}
+        self._process_config['RENDER_PROCESSES'] = 0
+        self._process_config['RENDER_THREADS'] = 1
+        self._executor = None
+        self._pid = None
+        self._serial = False
+        self._lock = threading.Lock()
+
+    def _create(self):
+        if self._processes > 0:
+            return ProcessPoolExecutor(
+                self._processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_render_process,
+                initargs=(self._process_config,))
+        return ThreadPoolExecutor(self._threads, thread_name_prefix='render')
+
+    def _get(self):
+        """ :return: the pool of this process, None to render serially """
+        with self._lock:
+            if self._pid != os.getpid():
+                # the pool of the parent process belongs to the parent
+                self._pid = os.getpid()
+                self._executor = None
+                self._serial = False
+                self._executor = self._create_or_fall_back()
+            return self._executor
+
+    def _create_or_fall_back(self):
+        try:
+            return self._create()
+        except Exception as e:
+            logger.error('Could not create the render pool, rendering serially: %s', e)
+            self._serial = True
+            return None
+
+    def _replace(self, broken):
+        """ Replaces the broken pool, once also if several of its labels failed
+        :return: the new pool, None to render serially
+        """
+        with self._lock:
+            if self._executor is broken and not self._serial:
+                logger.warning('The render pool is broken, creating a new one')
+                broken.shutdown(wait=False)
+                self._executor = self._create_or_fall_back()
+            return self._executor
+
+    def _submit(self, fn, args):
+        executor = self._get()
+        if executor is not None:
+            try:
+                return executor, executor.submit(fn, *args)
+            except BrokenExecutor:
+                executor = self._replace(executor)
+                if executor is not None:
+                    return executor, executor.submit(fn, *args)
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return None, future
+
+    def submit(self, fn, *args):
+        executor, future = self._submit(fn, args)
+        return RenderFuture(self, executor, future, fn, args)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait)
+            self._executor = None
+            self._pid = None
+            self._serial = False
+
+
+class RenderFuture:
+    """ Result of a label rendered by the RenderExecutor, rendered once more
+    if the pool broke before it was done
+    """
+
+    def __init__(self, render_executor, executor, future, fn, args):
+        self._render_executor = render_executor
+        self._executor = executor
+        self._future = future
+        self._fn = fn
+        self._args = args
+
+    def result(self, timeout=None):
+        try:
+            return self._future.result(timeout)
+        except BrokenExecutor:
+            # this or another label killed the render process, if it was this
+            # one it fails again and only this label is reported as failed
+            self._render_executor._replace(self._executor)
+            return self._render_executor._submit(self._fn, self._args)[1].result(timeout)
+
+
+def init_render_process(config):
+    # Labels are unpickled in the render processes, which requires the app
+    # (fonts and blueprints) to be set up like in the parent process
+    from app import create_app
+    create_app(type('RenderProcessConfig', (object,), config))
+
+
+class PrinterUnavailable(Exception):
+    """ Writing to the printer failed before any data reached it """
+
+
+class JobState(Enum):
+    QUEUED = 'queued'
+    RENDERING = 'rendering'
+    SENDING = 'sending'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class PrintJob:
+    def __init__(self, printer=None, pool=None, printer_name=None):
+        """
+        :param printer: the printer queue, selected from the pool on submit if None
+        :param pool: PrinterPool the job is routed by and which provides the
+            printers for the failover
+        :param printer_name: only print on the printer of the pool with this name
+        """
+        self.id = uuid.uuid4().hex
+        self.printer = printer
+        self.pool = pool
+        self.printer_name = printer_name
+        # device specifiers of the printers the job failed on
+        self.failed_printers = []
+        self.entries = []
+        self.count = 0
+        self.errors = []
+        self.message = None
+        self.timestamps = {}
+        self.state = JobState.QUEUED
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        self._state = value
+        self.timestamps[value.value] = time.time()
+
+    @property
+    def finished(self):
+        return self._state in (JobState.DONE, JobState.FAILED)
+
+    @property
+    def label_sizes(self):
+        return {entry['label_size'] for entry in self.entries}
+
+    def add_label(self, label, label_size, count=1, cut_once=False, item=None):
+        """
+        :param item: index of the label within a batch, used for error reporting
+        """
+        self.entries.append({
+            'label': label,
+            'label_size': label_size,
+            'count': count,
+            'cut_once': cut_once,
+            'item': item
+        })
+        self.count += count
+
+    def route(self, load=None, exclude=()):
+        """ Selects the printer of the job from the pool
+        :param load: number of queued labels per device specifier
+        """
+        self.printer = self.pool.route(self.label_sizes, load, self.printer_name, exclude, self.model)
+
+    @property
+    def model(self):
+        """ :return: the printer model the job requires, None for any """
+        return None
+
+    def run(self, executor=None, prefetch=4, load=None):
+        """
+        :param load: callable returning the number of queued labels per device
+            specifier, used to select another printer if the job's printer fails
+        """
+        try:
+            while True:
+                if self.pool is not None and not self.pool.available(self.printer.device_specifier):
+                    # the printer failed since the job was queued, prefer another one
+                    try:
+                        self.route(load() if load else None,
+                                   self.failed_printers + [self.printer.device_specifier])
+                    except LookupError:
+                        pass
+                try:
+                    self._print(executor, prefetch)
+                    break
+                except PrinterUnavailable as e:
+                    self.failed_printers.append(self.printer.device_specifier)
+                    if self.pool is None:
+                        raise
+                    try:
+                        self.route(load() if load else None, self.failed_printers)
+                    except LookupError:
+                        raise e from None
+                    logger.warning('Print job %s failed on %s (%s), retrying on %s',
+                                   self.id, self.failed_printers[-1], e, self.printer.device_specifier)
+        except Exception as e:
+            self.message = str(e)
+            self.state = JobState.FAILED
+            logger.error('Print job %s failed: %s', self.id, e)
+        else:
+            self.state = JobState.DONE
+        finally:
+            # the labels may hold large images, they are not needed anymore
+            self.entries = []
+
+    def _print(self, executor, prefetch):
+        with self.printer.lock:
+            self.state = JobState.RENDERING
+            for entry in self.entries:
+                self.printer.add_label_to_queue(
+                    entry['label'], entry['label_size'], entry['count'], entry['cut_once'])
+            errors = []
+            chunks = self.printer.iter_raster_queue(executor, errors, prefetch)
+
+            try:
+                # start sending as soon as the first label is rasterized
+                first_chunk = next(chunks, None)
+                if first_chunk is None and errors:
+                    raise errors[0][1]
+
+                if first_chunk is not None:
+                    self.state = JobState.SENDING
+                    self._write(itertools.chain([first_chunk], chunks))
+            except PrinterUnavailable:
+                # the labels are rendered again for the next printer
+                errors.clear()
+                raise
+            finally:
+                self._add_errors(errors)
+
+    def _write(self, chunks):
+        """ Only errors of the printer mark it as failed, errors of the chunks
+        (e.g. rendering the labels) fail the job
+        """
+        # the printer module is part of the blueprint, which requires the app
+        from app.labeldesigner.printer import PrinterError
+
+        connection = self.printer.connection
+        bytes_written = connection.bytes_written
+        try:
+            self.printer.write_stream(chunks)
+        except PrinterError as e:
+            if self.pool is not None:
+                self.pool.mark_failed(self.printer.device_specifier, e)
+            if connection.bytes_written == bytes_written:
+                raise PrinterUnavailable(str(e)) from e
+            raise
+        if self.pool is not None:
+            self.pool.mark_ok(self.printer.device_specifier)
+
+    def _add_errors(self, errors):
+        items = {id(entry['label']): entry['item'] for entry in self.entries}
+        while errors:
+            label, e = errors.pop(0)
+            self.errors.append({'item': items[id(label)], 'message': str(e)})
+
+    def to_dict(self):
+        states = [state.value for state in JobState if state.value in self.timestamps]
+        durations = {}
+        for state, next_state in zip(states, states[1:]):
+            durations[state] = self.timestamps[next_state] - self.timestamps[state]
+
+        return {
+            'id': self.id,
+            'state': self._state.value,
+            'message': self.message,
+            'errors': self.errors,
+            'device_specifier': self.printer.device_specifier if self.printer else None,
+            'failed_printers': self.failed_printers,
+            'count': self.count,
+            'timestamps': self.timestamps,
+            'durations': durations
+        }
+
+
+class RasterJob(PrintJob):
+    """ Sends raster instructions which were rendered before, e.g. a file of
+    the raster spool, without rendering the labels again
+    """
+
+    def __init__(self, chunks, metadata, copies=1, printer=None, pool=None, printer_name=None):
+        """
+        :param chunks: callable returning an iterable of the raster instructions
+        :param metadata: model, label_sizes and labels of the raster instructions
+        :param copies: number of times the raster instructions are sent
+        """
+        super().__init__(printer, pool, printer_name)
+        self._chunks = chunks
+        self._metadata = metadata
+        self.copies = copies
+        self.count = metadata['labels'] * copies
+
+    @property
+    def label_sizes(self):
+        return set(self._metadata['label_sizes'])
+
+    @property
+    def model(self):
+        return self._metadata['model']
+
+    def _print(self, executor, prefetch):
+        if self.printer.model != self.model:
+            raise ValueError('The raster was rendered for {}, not for {}'.format(self.model, self.printer.model))
+        with self.printer.lock:
+            self.state = JobState.SENDING
+            self._write(itertools.chain.from_iterable(self._chunks() for _ in range(self.copies)))
+
+
+class PrintWorker(threading.Thread):
+    """ Background thread which owns the job queue of a single printer """
+
+    def __init__(self, device_specifier, executor=None, prefetch=4, load=None):
+        """
+        :param load: callable returning the number of queued labels per printer
+        """
+        super().__init__(name='print-worker {}'.format(device_specifier), daemon=True)
+        self._queue = queue.Queue()
+        self._executor = executor
+        self._prefetch = prefetch
+        self._load = load
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, job):
+        self._queue.put(job)
+
+    def wait_idle(self, timeout=None):
+        """ :return: False if the queued jobs weren't done within timeout """
+        with self._queue.all_tasks_done:
+            return self._queue.all_tasks_done.wait_for(
+                lambda: not self._queue.unfinished_tasks, timeout)
+
+    def run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job.run(self._executor, self._prefetch, self._load)
+            finally:
+                self._queue.task_done()
+
+
+class PrintJobs:
+    """ Dispatches print jobs to the worker of their printer and keeps track
+    of their state
+    """
+
+    def __init__(self, history=100, executor=None, prefetch=4):
+        self.history = history
+        self._executor = executor
+        self._prefetch = prefetch
+        self._jobs = OrderedDict()
+        self._workers = {}
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        """ Queues the job, a job without printer is routed to the least busy
+        or next printer of its pool
+        :raises LookupError: if no printer of the pool has the label sizes of the job
+        """
+        if job.printer is None:
+            job.route(self.load())
+
+        device_specifier = job.printer.device_specifier
+        with self._lock:
+            worker = self._workers.get(device_specifier)
+            if worker is None:
+                worker = PrintWorker(device_specifier, self._executor, self._prefetch, self.load)
+                worker.start()
+                self._workers[device_specifier] = worker
+
+            self._jobs[job.id] = job
+            finished = [job_id for job_id, j in self._jobs.items() if j.finished]
+            for job_id in finished[:max(len(finished) - self.history, 0)]:
+                del self._jobs[job_id]
+
+        worker.submit(job)
+        return job
+
+    @property
+    def executor(self):
+        return self._executor
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def join(self, timeout=None):
+        """ Waits until the queued jobs of all printers are done
+        :return: False if they weren't done within timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            workers = list(self._workers.values())
+        for worker in workers:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not worker.wait_idle(remaining):
+                return False
+        return True
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def load(self):
+        """ :return: number of labels of the unfinished jobs per device specifier """
+        load = Counter()
+        with self._lock:
+            for job in self._jobs.values():
+                if not job.finished and job.printer is not None:
+                    load[job.printer.device_specifier] += job.count
+        return load
+
+    def queue_depth(self):
+        with self._lock:
+            return {device_specifier: worker.queue_depth
+                    for device_specifier, worker in self._workers.items()}
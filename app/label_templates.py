@@ -0,0 +1,58 @@
+import os
+import re
+import json
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+NAME_PATTERN = re.compile(r'[\w\- ]{1,64}')
+
+
+class LabelTemplates:
+    """ Stores the parameters of label templates as JSON files in a folder """
+
+    def __init__(self, folder):
+        """
+        :param folder: directory the templates are stored in
+        """
+        self.folder = folder
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        if not NAME_PATTERN.fullmatch(name):
+            raise ValueError('Invalid template name, use letters, digits, spaces, - and _')
+        return os.path.join(self.folder, name + '.json')
+
+    def names(self):
+        try:
+            filenames = os.listdir(self.folder)
+        except OSError:
+            return []
+        return sorted(filename[:-len('.json')] for filename in filenames if filename.endswith('.json'))
+
+    def get(self, name):
+        """ :return: the parameters of the template or None if it doesn't exist """
+        try:
+            with open(self._path(name), encoding='utf-8') as f:
+                return json.load(f)['parameters']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, name, parameters):
+        path = self._path(name)
+        with self._lock:
+            os.makedirs(self.folder, exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'name': name, 'parameters': parameters}, f, indent=2)
+            os.replace(tmp_path, path)
+
+    def delete(self, name):
+        """ :return: True if the template existed """
+        try:
+            os.remove(self._path(name))
+        except (FileNotFoundError, ValueError):
+            return False
+        return True
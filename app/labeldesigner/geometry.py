@@ -0,0 +1,87 @@
+from dataclasses import dataclass
+
+from brother_ql.devicedependent import label_type_specs, label_sizes
+from brother_ql.devicedependent import ENDLESS_LABEL, DIE_CUT_LABEL
+
+from .label import LabelOrientation, LabelType
+
+
+@dataclass(frozen=True)
+class LabelGeometry:
+    """ Geometry of a label size in one orientation """
+    __slots__ = ('label_size', 'name', 'label_type', 'orientation', 'width', 'height',
+                 'dots_printable', 'tape_size', 'rotate', 'red')
+
+    label_size: str
+    name: str
+    label_type: LabelType
+    orientation: LabelOrientation
+    # size of the label image, 0 along the feed direction of endless labels
+    width: int
+    height: int
+    dots_printable: tuple
+    tape_size: tuple
+    # rotation applied by brother_ql when rasterizing the label image
+    rotate: object
+    red: bool
+
+    def to_dict(self):
+        return {
+            'label_size': self.label_size,
+            'name': self.name,
+            'label_type': self.label_type.name.lower(),
+            'orientation': self.orientation.name.lower(),
+            'width': self.width,
+            'height': self.height,
+            'dots_printable': self.dots_printable,
+            'tape_size': self.tape_size,
+            'rotate': self.rotate,
+            'red': self.red
+        }
+
+
+def create_label_geometry(label_size, orientation):
+    spec = label_type_specs[label_size]
+
+    if spec['kind'] == ENDLESS_LABEL:
+        label_type = LabelType.ENDLESS_LABEL
+        rotate = 0 if orientation == LabelOrientation.STANDARD else 90
+    elif spec['kind'] == DIE_CUT_LABEL:
+        label_type = LabelType.DIE_CUT_LABEL
+        rotate = 'auto'
+    else:
+        label_type = LabelType.ROUND_DIE_CUT_LABEL
+        rotate = 'auto'
+
+    width, height = spec['dots_printable']
+    if height > width:
+        width, height = height, width
+    if orientation == LabelOrientation.ROTATED:
+        height, width = width, height
+
+    return LabelGeometry(
+        label_size=label_size,
+        name=spec['name'],
+        label_type=label_type,
+        orientation=orientation,
+        width=width,
+        height=height,
+        dots_printable=tuple(spec['dots_printable']),
+        tape_size=tuple(spec['tape_size']),
+        rotate=rotate,
+        red='red' in label_size)
+
+
+# built once, the label sizes of brother_ql don't change at runtime
+LABEL_GEOMETRIES = {
+    (label_size, orientation): create_label_geometry(label_size, orientation)
+    for label_size in label_sizes
+    for orientation in LabelOrientation
+}
+
+
+def get_label_geometry(label_size, orientation):
+    try:
+        return LABEL_GEOMETRIES[(label_size, orientation)]
+    except KeyError:
+        raise LookupError("Unknown label_size")
@@ -1,6 +1,109 @@
 from enum import Enum, auto
+from functools import lru_cache
+from string import Formatter
 from qrcode import QRCode, constants
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageChops
+
+from app.fonts import FONT_POOL, font_mtime
+from app.metrics import stage
+
+
+@lru_cache(maxsize=1024)
+def qr_matrix(data, error_correction):
+    """ Encodes the data as QR code, cached for labels which are printed repeatedly
+    :return: (size, bytes) with one byte per module, 0 for dark and 1 for light modules
+    """
+    qr = QRCode(
+        version=1,
+        error_correction=error_correction,
+        border=0,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    return len(matrix), bytes(0 if module else 1 for row in matrix for module in row)
+
+
+@lru_cache(maxsize=4096)
+def line_metrics(font_path, font_mtime, font_size, line):
+    """ Measures a single line of text. Cached per line, so only the changed
+    lines of a multiline text are measured again while it is edited.
+    :param font_mtime: only part of the cache key, see app.fonts.font_mtime
+    :return: (width, advance length) as ImageDraw uses them for the size and the alignment
+    """
+    font = FONT_POOL.get(font_path, font_size)
+    return font.getbbox(line)[2], font.getlength(line)
+
+
+@lru_cache(maxsize=256)
+def line_height(font_path, font_mtime, font_size):
+    """ :return: height of a line without spacing, the height of 'A' like ImageDraw """
+    return FONT_POOL.get(font_path, font_size).getbbox('A')[3]
+
+
+# brother_ql prints pixels whose inverted grey value reaches its threshold (default 70%)
+PRINT_THRESHOLD = min(255, max(0, int((100.0 - 70) / 100.0 * 255)))
+BLACK_TABLE = [0 if 255 - x >= PRINT_THRESHOLD else 255 for x in range(256)]
+# black and red tapes: pixels are classified by their hue, saturation and value like brother_ql
+RED_HUE_TABLE = [255 if (h < 40 or h > 210) else 0 for h in range(256)]
+RED_SATURATION_TABLE = [255 if s > 100 else 0 for s in range(256)]
+RED_VALUE_TABLE = [255 if v > 80 else 0 for v in range(256)]
+BLACK_VALUE_TABLE = [255 if v < 80 else 0 for v in range(256)]
+PRINTED_TABLE = [255 if 255 - x >= PRINT_THRESHOLD else 0 for x in range(256)]
+BLACK_RED_PALETTE = (255, 255, 255) + (0, 0, 0) + (255, 0, 0)
+
+
+def reduce_to_black_red(img):
+    """ Reduces an RGB image to the white, black and red pixels brother_ql prints on
+    black and red tapes
+    :return: palette image with the colors BLACK_RED_PALETTE
+    """
+    h, s, v = img.convert('HSV').split()
+    printed = img.convert('L').point(PRINTED_TABLE)
+    red = ImageChops.multiply(
+        ImageChops.multiply(h.point(RED_HUE_TABLE), s.point(RED_SATURATION_TABLE)),
+        ImageChops.multiply(v.point(RED_VALUE_TABLE), printed))
+    black = ImageChops.subtract(ImageChops.multiply(v.point(BLACK_VALUE_TABLE), printed), red)
+
+    result = Image.new('P', img.size, 0)
+    result.putpalette(BLACK_RED_PALETTE)
+    result.paste(1, mask=black)
+    result.paste(2, mask=red)
+    return result
+
+
+class TextLayout:
+    """ Layout of a multiline text, computes the same size and line positions as
+    ImageDraw.multiline_textsize() and multiline_text() from the cached line metrics
+    """
+
+    def __init__(self, text, font_path, font_size, spacing, align):
+        self.lines = text.split('\n')
+        mtime = font_mtime(font_path)
+        self.line_spacing = line_height(font_path, mtime, font_size) + spacing
+        metrics = [line_metrics(font_path, mtime, font_size, line) for line in self.lines]
+        self.size = (
+            max(width for width, _ in metrics),
+            len(self.lines) * self.line_spacing - spacing)
+
+        align = getattr(align, 'value', align)
+        if align not in ('left', 'center', 'right'):
+            raise ValueError('align must be "left", "center" or "right"')
+        max_length = max(length for _, length in metrics)
+        self.offsets = []
+        for _, length in metrics:
+            if align == 'left':
+                self.offsets.append(0)
+            elif align == 'center':
+                self.offsets.append((max_length - length) / 2.0)
+            else:
+                self.offsets.append(max_length - length)
+
+    def draw(self, draw, xy, fill, font):
+        left, top = xy
+        for line, offset in zip(self.lines, self.offsets):
+            draw.text((left + offset, top), line, fill, font=font)
+            top += self.line_spacing
 
 
 class LabelContent(Enum):
@@ -21,6 +124,16 @@ class LabelType(Enum):
     ROUND_DIE_CUT_LABEL = auto()
 
 
+class RenderMode(Enum):
+    RGB = auto()
+    # 1-bit image, for black tapes
+    BLACK = auto()
+    # palette image with white, black and red, for black and red tapes
+    BLACK_RED = auto()
+    # anti-aliased greyscale image, e.g. for previews of black tapes
+    GREY = auto()
+
+
 class TextAlign(Enum):
     LEFT = 'left'
     CENTER = 'center'
@@ -51,7 +164,8 @@ class SimpleLabel:
             image=None,
             font_path='',
             font_size=70,
-            line_spacing=100):
+            line_spacing=100,
+            render_mode=RenderMode.RGB):
         self._width = width
         self._height = height
         self.label_content = label_content
@@ -67,6 +181,7 @@ class SimpleLabel:
         self._font_path = font_path
         self._font_size = font_size
         self._line_spacing = line_spacing
+        self._render_mode = render_mode
 
     @property
     def label_content(self):
@@ -83,6 +198,7 @@ class SimpleLabel:
     @text.setter
     def text(self, value):
         self._text = value
+        self._text_layout = None
 
     @property
     def qr_correction(self):
@@ -113,9 +229,12 @@ class SimpleLabel:
 
     def generate(self):
         if self._label_content in (LabelContent.QRCODE_ONLY, LabelContent.TEXT_QRCODE):
-            img = self._generate_qr()
+            with stage('qr'):
+                img = self._generate_qr()
         elif self._label_content == LabelContent.IMAGE:
-            img = self._image
+            # images can be loaded lazily, e.g. the pages of a PDF
+            with stage('image'):
+                img = self._image() if callable(self._image) else self._image
         else:
             img = None
 
@@ -125,7 +244,8 @@ class SimpleLabel:
             img_width, img_height = (0, 0)
 
         if self._label_content in (LabelContent.TEXT_ONLY, LabelContent.TEXT_QRCODE):
-            textsize = self._get_text_size()
+            with stage('text_layout'):
+                textsize = self._get_text_size()
         else:
             textsize = (0, 0)
 
@@ -165,45 +285,53 @@ class SimpleLabel:
         text_offset = horizontal_offset_text, vertical_offset_text
         image_offset = horizontal_offset_image, vertical_offset_image
 
-        imgResult = Image.new('RGB', (width, height), 'white')
+        with stage('draw'):
+            return self._draw(width, height, img, image_offset, text_offset)
+
+    def _draw(self, width, height, img, image_offset, text_offset):
+        if self._render_mode in (RenderMode.BLACK, RenderMode.GREY):
+            # greyscale is enough for black text, it is reduced to 1-bit below
+            imgResult = Image.new('L', (width, height), 255)
+            fore_color = 0
+        else:
+            imgResult = Image.new('RGB', (width, height), 'white')
+            fore_color = self._fore_color
 
         if img is not None:
             imgResult.paste(img, image_offset)
 
         if self._label_content in (LabelContent.TEXT_ONLY, LabelContent.TEXT_QRCODE):
             draw = ImageDraw.Draw(imgResult)
-            draw.multiline_text(
-                text_offset,
-                self._prepare_text(self._text),
-                self._fore_color,
-                font=self._get_font(),
-                align=self._text_align,
-                spacing=int(self._font_size*((self._line_spacing - 100) / 100)))
+            self._get_text_layout().draw(draw, text_offset, fore_color, self._get_font())
 
+        # reduce the label to the pixels which are printed, like brother_ql does
+        if self._render_mode == RenderMode.BLACK:
+            return imgResult.point(BLACK_TABLE, '1')
+        elif self._render_mode == RenderMode.BLACK_RED:
+            return reduce_to_black_red(imgResult)
         return imgResult
 
     def _generate_qr(self):
-        qr = QRCode(
-            version=1,
-            error_correction=self._qr_correction,
-            box_size=self._qr_size,
-            border=0,
-        )
-        qr.add_data(self._text)
-        qr.make(fit=True)
-        qr_img = qr.make_image(
-            fill_color='red' if (255, 0, 0) == self._fore_color else 'black',
-            back_color="white")
-        return qr_img
+        size, modules = qr_matrix(self._text, self._qr_correction)
+        # one pixel per module, scaled up to the box size without interpolation
+        qr_img = Image.frombytes('P', (size, size), modules)
+        qr_img.putpalette(
+            ((255, 0, 0) if (255, 0, 0) == self._fore_color else (0, 0, 0)) + (255, 255, 255))
+        return qr_img.resize((size * self._qr_size, size * self._qr_size), Image.NEAREST)
 
     def _get_text_size(self):
-        font = self._get_font()
-        img = Image.new('L', (20, 20), 'white')
-        draw = ImageDraw.Draw(img)
-        return draw.multiline_textsize(
-            self._prepare_text(self._text),
-            font=font,
-            spacing=int(self._font_size*((self._line_spacing - 100) / 100)))
+        return self._get_text_layout().size
+
+    def _get_text_layout(self):
+        # measured once and used for the size and for drawing
+        if self._text_layout is None:
+            self._text_layout = TextLayout(
+                self._prepare_text(self._text),
+                self._font_path,
+                self._font_size,
+                int(self._font_size*((self._line_spacing - 100) / 100)),
+                self._text_align)
+        return self._text_layout
 
     @staticmethod
     def _prepare_text(text):
@@ -217,4 +345,49 @@ class SimpleLabel:
         return '\n'.join(lines)
 
     def _get_font(self):
-        return ImageFont.truetype(self._font_path, self._font_size)
+        return FONT_POOL.get(self._font_path, self._font_size)
+
+
+class LabelTemplate:
+    """ Precompiled label whose text contains placeholders like {name}, which
+    are filled from the fields of a record. Everything else (geometry, fonts,
+    images) is parsed once for all records.
+    """
+
+    def __init__(self, label_arguments):
+        """
+        :param label_arguments: keyword arguments of SimpleLabel
+        """
+        self._label_arguments = label_arguments
+        self._text = []
+        self.placeholders = []
+        for literal, field, format_spec, conversion in Formatter().parse(label_arguments['text'] or ''):
+            self._text.append((literal, field))
+            if field is not None:
+                if field == '' or format_spec or conversion:
+                    raise ValueError('Invalid placeholder in the label text, use {name}')
+                if field not in self.placeholders:
+                    self.placeholders.append(field)
+        self._labels = {}
+
+    def format_text(self, record):
+        """ :return: the text of the label with the placeholders replaced by the values of the record """
+        parts = []
+        for literal, field in self._text:
+            parts.append(literal)
+            if field is not None:
+                try:
+                    parts.append(str(record[field]))
+                except KeyError:
+                    raise LookupError("Missing value for placeholder '{}'".format(field))
+        return ''.join(parts)
+
+    def create_label(self, record):
+        """ Records with the same text share the label object, which is then
+        rendered only once per print job
+        """
+        text = self.format_text(record)
+        label = self._labels.get(text)
+        if label is None:
+            label = self._labels[text] = SimpleLabel(**dict(self._label_arguments, text=text))
+        return label
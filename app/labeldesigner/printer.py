@@ -1,21 +1,324 @@
+import logging
+import select
+import socket
+import threading
+import time
+import itertools
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future
+
 from brother_ql.backends import backend_factory, guess_backend
 from brother_ql import BrotherQLRaster, create_label
-from .label import LabelOrientation, LabelType
+from app.metrics import stage
+from .geometry import get_label_geometry
 
+logger = logging.getLogger(__name__)
+
+_printer_queues = {}
+_printer_queues_lock = threading.Lock()
+
+
+def get_printer_queue(model, device_specifier, idle_timeout=0):
+    """ Returns the long-lived queue of the given printer, the backend is
+    only resolved when the queue is created
+    """
+    with _printer_queues_lock:
+        printer_queue = _printer_queues.get(device_specifier)
+        if printer_queue is None:
+            printer_queue = PrinterQueue(model, device_specifier, idle_timeout)
+            _printer_queues[device_specifier] = printer_queue
+        return printer_queue
+
+
+def printer_queues():
+    with _printer_queues_lock:
+        return list(_printer_queues.values())
+
+
+DISPATCH_LEAST_BUSY = 'least-busy'
+DISPATCH_ROUND_ROBIN = 'round-robin'
+DISPATCH_MODES = (DISPATCH_LEAST_BUSY, DISPATCH_ROUND_ROBIN)
+
+
+class PooledPrinter:
+    """ A printer of the pool with the label sizes loaded into it """
+
+    def __init__(self, name, printer_queue, label_sizes=None):
+        """
+        :param label_sizes: label sizes the printer accepts, None for any
+        """
+        self.name = name
+        self.queue = printer_queue
+        self.label_sizes = None if label_sizes is None else frozenset(label_sizes)
+        self.failed_at = None
+        self.last_error = None
+        self.failures = 0
+
+    def supports(self, label_sizes):
+        return self.label_sizes is None or self.label_sizes.issuperset(label_sizes)
+
+    def available(self, retry_delay):
+        return self.failed_at is None or time.monotonic() - self.failed_at >= retry_delay
+
+    def to_dict(self, retry_delay):
+        return {
+            'name': self.name,
+            'model': self.queue.model,
+            'device_specifier': self.queue.device_specifier,
+            'label_sizes': None if self.label_sizes is None else sorted(self.label_sizes),
+            'available': self.available(retry_delay),
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'connection': self.queue.connection.stats()
+        }
+
+
+class PrinterPool:
+    """ Routes print jobs to the printers with the requested label sizes
+
+    Jobs are distributed over the matching printers by the dispatch mode.
+    A printer which failed is skipped for retry_delay seconds, unless it is
+    the only one with the label size.
+    """
+
+    def __init__(self, dispatch=DISPATCH_LEAST_BUSY, retry_delay=60):
+        self._printers = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self.configure(dispatch, retry_delay)
+
+    def configure(self, dispatch, retry_delay):
+        if dispatch not in DISPATCH_MODES:
+            raise ValueError('Unknown dispatch mode {}, use one of {}'.format(dispatch, ', '.join(DISPATCH_MODES)))
+        self.dispatch = dispatch
+        self.retry_delay = retry_delay
+
+    def add(self, name, printer_queue, label_sizes=None):
+        with self._lock:
+            if any(printer.name == name for printer in self._printers):
+                raise ValueError('Duplicate printer name {}'.format(name))
+            self._printers.append(PooledPrinter(name, printer_queue, label_sizes))
+
+    def clear(self):
+        with self._lock:
+            self._printers = []
+
+    def printers(self):
+        with self._lock:
+            return list(self._printers)
+
+    def get(self, device_specifier):
+        for printer in self.printers():
+            if printer.queue.device_specifier == device_specifier:
+                return printer
+        return None
+
+    def route(self, label_sizes, load=None, name=None, exclude=(), model=None):
+        """ Selects the printer for a job
+        :param label_sizes: label sizes of the job
+        :param load: number of queued labels per device specifier
+        :param name: only consider the printer with this name
+        :param exclude: device specifiers which are skipped, e.g. printers the job failed on
+        :param model: only consider printers of this model, e.g. for rendered raster instructions
+        :return: the PrinterQueue of the selected printer
+        """
+        load = load or {}
+        printers = self.printers()
+        if name:
+            printers = [printer for printer in printers if printer.name == name]
+            if not printers:
+                raise LookupError('Unknown printer {}'.format(name))
+
+        candidates = [printer for printer in printers
+                      if printer.supports(label_sizes) and printer.queue.device_specifier not in exclude
+                      and (model is None or printer.queue.model == model)]
+        if not candidates:
+            raise LookupError('No printer available for label size {}{}'.format(
+                ', '.join(sorted(label_sizes)), '' if model is None else ' and model ' + model))
+        available = [printer for printer in candidates if printer.available(self.retry_delay)]
+        if available:
+            candidates = available
+
+        # rotating the candidates spreads the jobs of equally busy printers
+        offset = next(self._counter) % len(candidates)
+        candidates = candidates[offset:] + candidates[:offset]
+        if self.dispatch == DISPATCH_LEAST_BUSY:
+            candidates.sort(key=lambda printer: load.get(printer.queue.device_specifier, 0))
+        return candidates[0].queue
+
+    def available(self, device_specifier):
+        printer = self.get(device_specifier)
+        return printer is None or printer.available(self.retry_delay)
+
+    def mark_failed(self, device_specifier, error):
+        printer = self.get(device_specifier)
+        if printer is not None:
+            printer.failed_at = time.monotonic()
+            printer.last_error = str(error)
+            printer.failures += 1
+
+    def mark_ok(self, device_specifier):
+        printer = self.get(device_specifier)
+        if printer is not None:
+            printer.failed_at = None
+
+    def status(self, load=None):
+        load = load or {}
+        printers = []
+        for printer in self.printers():
+            status = printer.to_dict(self.retry_delay)
+            status['queued_labels'] = load.get(printer.queue.device_specifier, 0)
+            printers.append(status)
+        return {'dispatch': self.dispatch, 'printers': printers}
+
+
+# configured from the app config when the blueprint is registered
+PRINTER_POOL = PrinterPool()
+
+
+class PrinterError(Exception):
+    """ Connecting or writing to the printer failed, errors of the written
+    chunks (e.g. rendering the labels) are raised as they are
+    """
 
-class PrinterQueue:
 
-    _printQueue = []
-    _cutQueue = []
+class BackendConnection:
+    """ Keeps the printer backend open between jobs
+
+    The backend is closed after being idle for idle_timeout seconds (0 closes
+    it after every write). Stale connections are detected before writing and
+    when a write fails; in both cases the backend is opened again.
+    """
+
+    def __init__(self, backend_class, device_specifier, idle_timeout=0):
+        self._backend_class = backend_class
+        self._device_specifier = device_specifier
+        self.idle_timeout = idle_timeout
+        self._backend = None
+        self._idle_timer = None
+        self._lock = threading.RLock()
+        self.connects = 0
+        self.reconnects = 0
+        self.connect_time = 0.0
+        self.bytes_written = 0
+        self.write_time = 0.0
+
+    @property
+    def connected(self):
+        return self._backend is not None
+
+    def _connect(self):
+        start = time.perf_counter()
+        with stage('connect'):
+            self._backend = self._backend_class(self._device_specifier)
+        self.connect_time += time.perf_counter() - start
+        self.connects += 1
+
+        sock = getattr(self._backend, 's', None)
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def _is_stale(self):
+        sock = getattr(self._backend, 's', None)
+        if sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            # a readable socket without pending data was closed by the printer
+            return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+        except OSError:
+            return True
+
+    def close(self):
+        with self._lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            if self._backend is not None:
+                self._backend.dispose()
+                self._backend = None
+
+    def write(self, data):
+        self.write_stream([data])
+
+    def write_stream(self, chunks):
+        """ Writes the chunks one after the other as they are produced
+        :param chunks: iterable of bytes, e.g. a generator rendering the labels
+        """
+        with self._lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+
+            if self._backend is not None and self._is_stale():
+                logger.info('Connection to %s is stale, reconnecting', self._device_specifier)
+                self.close()
+                self.reconnects += 1
+            try:
+                if self._backend is None:
+                    self._connect()
+            except Exception as e:
+                raise PrinterError(str(e)) from e
+
+            try:
+                for index, chunk in enumerate(chunks):
+                    start = time.perf_counter()
+                    try:
+                        self._write_chunk(chunk, retry=index == 0)
+                    except Exception as e:
+                        raise PrinterError(str(e)) from e
+                    self.write_time += time.perf_counter() - start
+                    self.bytes_written += len(chunk)
+            finally:
+                if self.idle_timeout > 0 and self._backend is not None:
+                    self._idle_timer = threading.Timer(self.idle_timeout, self.close)
+                    self._idle_timer.daemon = True
+                    self._idle_timer.start()
+                else:
+                    self.close()
+
+    def _write_chunk(self, chunk, retry):
+        """ :param retry: reconnect once if the write fails, only safe as long
+            as nothing of the stream reached the printer
+        """
+        try:
+            with stage('write'):
+                self._backend.write(chunk)
+        except OSError as e:
+            if not retry:
+                raise
+            logger.warning('Writing to %s failed (%s), reconnecting', self._device_specifier, e)
+            self.close()
+            self.reconnects += 1
+            self._connect()
+            self._backend.write(chunk)
+
+    def stats(self):
+        return {
+            'connected': self.connected,
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'connect_latency': self.connect_time / self.connects if self.connects else 0.0,
+            'bytes_written': self.bytes_written,
+            'write_throughput': self.bytes_written / self.write_time if self.write_time else 0.0
+        }
+
+
+class PrinterQueue:
 
     def __init__(
             self,
             model,
             device_specifier,
-            label_size):
+            idle_timeout=0):
+        self._printQueue = []
+        # Hold the lock to add, rasterize and write a job without other
+        # threads interfering
+        self.lock = threading.RLock()
+        self.connection = None
+        self.idle_timeout = idle_timeout
         self.model = model
         self.device_specifier = device_specifier
-        self.label_size = label_size
 
     @property
     def model(self):
@@ -35,49 +338,128 @@ class PrinterQueue:
         selected_backend = guess_backend(self._device_specifier)
         self._backend_class = backend_factory(
             selected_backend)['backend_class']
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = BackendConnection(
+            self._backend_class, self._device_specifier, self.idle_timeout)
 
-    @property
-    def label_size(self):
-        return self._label_size
+    def add_label_to_queue(self, label, label_size, count, cut_once=False):
+        with self.lock:
+            self._printQueue.extend(queue_entries(label, label_size, count, cut_once))
 
-    @label_size.setter
-    def label_size(self, value):
-        self._label_size = value
+    def process_queue(self):
+        with self.lock:
+            self.write(self.rasterize_queue())
 
-    def add_label_to_queue(self, label, count, cut_once=False):
-        for cnt in range(0, count):
-            cut = (cut_once == False) or (cut_once and cnt == count-1)
+    def rasterize_queue(self, executor=None, errors=None):
+        """ Renders and rasterizes all queued labels and empties the queue
+        :return: the raster instructions for the printer
+        """
+        return b''.join(self.iter_raster_queue(executor, errors))
 
-            self._printQueue.append(
-                {'label': label,
-                 'cut': cut
-                 })
+    def iter_raster_queue(self, executor=None, errors=None, prefetch=4):
+        """ Empties the queue and yields the raster instructions label by label,
+        so they can be sent to the printer while later labels are still rendering,
+        see iter_raster
+        """
+        with self.lock:
+            print_queue, self._printQueue = self._printQueue, []
+        return iter_raster(self._model, print_queue, executor, errors, prefetch)
 
-    def process_queue(self):
-        qlr = BrotherQLRaster(self._model)
+    def write(self, data):
+        with self.lock:
+            self.connection.write(data)
+
+    def write_stream(self, chunks):
+        with self.lock:
+            self.connection.write_stream(chunks)
+
+
+def queue_entries(label, label_size, count, cut_once=False):
+    """ :return: one queue entry per copy, with cut_once only the last copy is cut """
+    return [{'label': label,
+             'label_size': label_size,
+             'cut': not cut_once or cnt == count - 1}
+            for cnt in range(count)]
+
+
+def iter_raster(model, print_queue, executor=None, errors=None, prefetch=4, compress=False):
+    """ Yields the raster instructions of the queue entries label by label
+    :param print_queue: list of queue entries, see queue_entries
+    :param executor: optional concurrent.futures executor to render the labels in parallel
+    :param errors: if given, labels which fail to render are skipped and
+        (label, exception) is appended to this list instead of raising
+    :param prefetch: number of labels the executor renders ahead
+    :param compress: compress the raster lines, if the model supports it
+    """
+    # The same label object is queued once per copy. Render and rasterize
+    # it only once and repeat the raster instructions for every copy.
+    labels = OrderedDict()
+    remaining = Counter()
+    for queue_entry in print_queue:
+        key = (id(queue_entry['label']), queue_entry['label_size'])
+        if key not in labels:
+            labels[key] = (queue_entry['label'], queue_entry['label_size'], set())
+        labels[key][2].add(queue_entry['cut'])
+        remaining[key] += 1
 
-        for queue_entry in self._printQueue:
-            if queue_entry['label'].label_type == LabelType.ENDLESS_LABEL:
-                if queue_entry['label'].label_orientation == LabelOrientation.STANDARD:
-                    rotate = 0
+    pending = deque(labels)
+    futures = {}
+    raster_blocks = {}
+
+    for queue_entry in print_queue:
+        key = (id(queue_entry['label']), queue_entry['label_size'])
+
+        if key not in raster_blocks:
+            try:
+                if executor is None:
+                    raster_blocks[key] = rasterize_label(model, *labels[key], compress)
                 else:
-                    rotate = 90
-            else:
-                rotate = 'auto'
-
-            img = queue_entry['label'].generate()
-
-            create_label(
-                qlr,
-                img,
-                self.label_size,
-                red='red' in self.label_size,
-                cut=queue_entry['cut'],
-                rotate=rotate)
-
-        self._printQueue.clear()
-
-        be = self._backend_class(self._device_specifier)
-        be.write(qlr.data)
-        be.dispose()
-        del be
+                    while pending and len(futures) < max(prefetch, 1):
+                        next_key = pending.popleft()
+                        try:
+                            futures[next_key] = executor.submit(
+                                rasterize_label, model, *labels[next_key], compress)
+                        except Exception as e:
+                            # reported with its label once the label is reached
+                            futures[next_key] = Future()
+                            futures[next_key].set_exception(e)
+                    raster_blocks[key] = futures.pop(key).result()
+            except Exception as e:
+                if errors is None:
+                    raise
+                errors.append((labels[key][0], e))
+                raster_blocks[key] = None
+
+        block = raster_blocks[key]
+        # drop the raster instructions after the last copy was sent
+        remaining[key] -= 1
+        if remaining[key] == 0:
+            del raster_blocks[key]
+        if block is not None:
+            yield block[queue_entry['cut']]
+
+
+def rasterize_label(model, label, label_size, cuts, compress=False):
+    """ Renders the label once and rasterizes it for every requested cut flag
+    :return: dict mapping the cut flag to the raster instructions
+    """
+    with stage('render'):
+        img = label.generate()
+    with stage('rasterize'):
+        return {cut: rasterize_image(model, label, img, label_size, cut, compress) for cut in cuts}
+
+
+def rasterize_image(model, label, img, label_size, cut, compress=False):
+    geometry = get_label_geometry(label_size, label.label_orientation)
+
+    qlr = BrotherQLRaster(model)
+    create_label(
+        qlr,
+        img,
+        label_size,
+        red=geometry.red,
+        cut=cut,
+        compress=compress,
+        rotate=geometry.rotate)
+    return qlr.data
@@ -1,28 +1,93 @@
+import io
 import os
+import sys
+import csv
+import json
+import base64
+import hashlib
+import functools
+from collections import Counter
 
-from flask import current_app, render_template, request, make_response
-
-from brother_ql.devicedependent import label_type_specs, label_sizes
-from brother_ql.devicedependent import ENDLESS_LABEL, DIE_CUT_LABEL, ROUND_DIE_CUT_LABEL
+from flask import current_app, render_template, request, make_response, abort, send_file
 
 from . import bp
-from app.utils import convert_image_to_bw, pdffile_to_image, imgfile_to_image, image_to_png_bytes
-from app import FONTS
-
-from .label import SimpleLabel, LabelContent, LabelOrientation, LabelType
-from .printer import PrinterQueue
+from app.utils import convert_image_to_bw, pdffile_to_image, imgfile_to_image
+from app.utils import scale_preview, image_to_preview_bytes
+from app.utils import pdffile_page_count, parse_page_range
+from app.utils import DITHER_MODES, DITHER_NONE, DITHER_FLOYD_STEINBERG, DITHER_ORDERED
+from app import FONTS, PREVIEW_CACHE, PREVIEW_COALESCER, PRINT_JOBS, UPLOADS, LABEL_TEMPLATES, RASTER_SPOOL
+from app.coalescing import Superseded
+from app.uploads import MissingUpload
+from app.jobs import PrintJob, RasterJob
+from app.fonts import FONT_POOL
+from app.metrics import REGISTRY, stage, format_family
+
+from .label import SimpleLabel, LabelTemplate, LabelContent, LabelOrientation, LabelType, RenderMode
+from .printer import get_printer_queue, printer_queues, queue_entries, iter_raster, PRINTER_POOL
+from .geometry import LABEL_GEOMETRIES, get_label_geometry
+
+from brother_ql.devicedependent import models as PRINTER_MODELS
 
 LINE_SPACINGS = (100, 150, 200, 250, 300)
 
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.pdf')
+
+PREVIEW_FORMATS = {'png': 'image/png', 'webp': 'image/webp'}
+
+# label parameters which are stored in a template
+TEMPLATE_PARAMETERS = (
+    'label_size', 'print_type', 'orientation', 'margin_top', 'margin_bottom', 'margin_left',
+    'margin_right', 'text', 'align', 'qrcode_size', 'qrcode_correction', 'font_size',
+    'line_spacing', 'font_family', 'font_style', 'print_color', 'image_dither', 'image_token',
+    'pdf_pages')
+
+IMAGE_DITHER_MODES = (
+    (DITHER_NONE, 'Threshold'),
+    (DITHER_FLOYD_STEINBERG, 'Floyd-Steinberg Dithering'),
+    (DITHER_ORDERED, 'Ordered Dithering'),
+)
+
 # Don't change as brother_ql is using this DPI value
 DEFAULT_DPI = 300
 
 LABEL_SIZES = [(
-    name,
-    label_type_specs[name]['name'],
-    (label_type_specs[name]['kind'] in (
-        ROUND_DIE_CUT_LABEL,))  # True if round label
-) for name in label_sizes]
+    geometry.label_size,
+    geometry.name,
+    geometry.label_type == LabelType.ROUND_DIE_CUT_LABEL  # True if round label
+) for (label_size, orientation), geometry in LABEL_GEOMETRIES.items()
+    if orientation == LabelOrientation.STANDARD]
+
+# the label sizes don't change at runtime, the response is built once
+LABEL_SIZES_JSON = json.dumps(
+    [geometry.to_dict() for geometry in LABEL_GEOMETRIES.values()])
+LABEL_SIZES_ETAG = hashlib.sha256(LABEL_SIZES_JSON.encode('utf-8')).hexdigest()
+
+
+@bp.record_once
+def setup_printer(state):
+    # resolve the printer backends once at startup instead of on every request
+    config = state.app.config
+    printers = config['PRINTERS'] or [{
+        'name': 'default',
+        'model': config['PRINTER_MODEL'],
+        'device_specifier': config['PRINTER_PRINTER']
+    }]
+
+    PRINTER_POOL.configure(config['PRINTER_DISPATCH'], config['PRINTER_RETRY_DELAY'])
+    PRINTER_POOL.clear()
+    for printer in printers:
+        label_sizes = printer.get('label_sizes')
+        unknown = set(label_sizes or ()).difference(label_size for label_size, _ in LABEL_GEOMETRIES)
+        if unknown:
+            raise ValueError('Unknown label sizes {} of printer {}'.format(
+                ', '.join(sorted(unknown)), printer['device_specifier']))
+        PRINTER_POOL.add(
+            printer.get('name', printer['device_specifier']),
+            get_printer_queue(
+                model = printer.get('model', config['PRINTER_MODEL']),
+                device_specifier = printer['device_specifier'],
+                idle_timeout = config['PRINTER_IDLE_TIMEOUT']),
+            label_sizes)
 
 
 @bp.route('/')
@@ -37,10 +102,26 @@ def index():
                            default_font_family=current_app.config['LABEL_DEFAULT_FONT_FAMILY'],
                            line_spacings=LINE_SPACINGS,
                            default_line_spacing=current_app.config['LABEL_DEFAULT_LINE_SPACING'],
-                           default_dpi=DEFAULT_DPI
+                           default_dpi=DEFAULT_DPI,
+                           image_dither_modes=IMAGE_DITHER_MODES,
+                           default_image_dither=current_app.config['IMAGE_DITHER'],
+                           printers=[printer.name for printer in PRINTER_POOL.printers()]
                            )
 
 
+@bp.route('/api/label_sizes', methods=['GET'])
+def get_label_sizes():
+    if LABEL_SIZES_ETAG in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = make_response(LABEL_SIZES_JSON)
+        response.headers.set('Content-type', 'application/json')
+    response.set_etag(LABEL_SIZES_ETAG)
+    response.cache_control.public = True
+    response.cache_control.max_age = 24 * 60 * 60
+    return response
+
+
 @bp.route('/api/font/styles', methods=['POST', 'GET'])
 def get_font_styles():
     font = request.values.get(
@@ -48,22 +129,188 @@ def get_font_styles():
     return FONTS.fonts[font]
 
 
+@bp.route('/api/font/rescan', methods=['POST'])
+def rescan_fonts():
+    FONTS.scan()
+    return {
+        'success': True,
+        'fonts': FONTS.fonts_available() or 0
+    }
+
+
+@bp.route('/api/upload', methods=['POST'])
+def upload_image():
+    """
+    API to upload an image once for the following previews and prints
+
+    returns: JSON with the token which is passed as image_token instead of the image
+    """
+
+    image = request.files.get('image', None)
+    if image is None:
+        return {'success': False, 'message': 'No image uploaded'}
+
+    name, ext = os.path.splitext(image.filename or '')
+    if ext.lower() not in IMAGE_EXTENSIONS:
+        return {'success': False, 'message': 'Unsupported image format'}
+
+    return {
+        'success': True,
+        'token': UPLOADS.store(image)
+    }
+
+
 @bp.route('/api/preview', methods=['POST', 'GET'])
 def get_preview_from_image():
-    label = create_label_from_request(request)
-    im = label.generate()
+    """
+    API to render the preview of a label
+
+    Optional parameters to reduce the size of the preview:
+    - scale: factor between 0 and 1 relative to the printed size
+    - max_width: maximum width in pixels
+    - draft: 1 to render the label at the reduced size, faster but less exact
+    - image_format: png (default) or webp
 
-    return_format = request.values.get('return_format', 'png')
+    The size of the printed label in pixels is sent in the X-Label-Width
+    and X-Label-Height headers.
+
+    With client_id and seq (increasing per client) the previews of a client
+    are rendered one after the other and a preview is answered with 409 if
+    a newer one of the same client arrived before it was rendered.
+    """
+    client_id, seq = request.values.get('client_id'), request.values.get('seq', type=int)
+    PREVIEW_COALESCER.register(client_id, seq)
+
+    with stage('parse'):
+        return_format = request.values.get('return_format', 'png')
+        preview_options = get_preview_options(request.values)
+        cache_key = get_preview_cache_key(request, return_format, preview_options)
+
+    if cache_key in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(cache_key)
+        return response
 
+    entry = PREVIEW_CACHE.get(cache_key)
+    if entry is None:
+        try:
+            with PREVIEW_COALESCER.render(client_id, seq) as render:
+                entry = render_preview(request, return_format, preview_options, render)
+        except Superseded:
+            return {'success': False, 'message': 'Superseded by a newer preview'}, 409
+        except MissingUpload as e:
+            return {'success': False, 'message': str(e)}, 400
+        PREVIEW_CACHE.set(cache_key, entry)
+
+    preview, label_size = entry
+    response = make_response(preview)
     if return_format == 'base64':
-        import base64
-        response = make_response(base64.b64encode(image_to_png_bytes(im)))
         response.headers.set('Content-type', 'text/plain')
-        return response
     else:
-        response = make_response(image_to_png_bytes(im))
-        response.headers.set('Content-type', 'image/png')
-        return response
+        response.headers.set('Content-type', PREVIEW_FORMATS[preview_options['image_format']])
+    response.headers.set('X-Label-Width', label_size[0])
+    response.headers.set('X-Label-Height', label_size[1])
+    response.set_etag(cache_key)
+    return response
+
+
+def render_preview(request, return_format, preview_options, render):
+    """ Renders the preview, abandoned between the stages if it was superseded
+    :param render: Render of the coalescer, checked between the stages
+    :return: (preview, label size)
+    """
+    with stage('label'):
+        label, draft_scale = create_preview_label(request, preview_options)
+    render.check()
+    with stage('render'):
+        im = label.generate()
+    render.check()
+    label_size = (round(im.width / draft_scale), round(im.height / draft_scale))
+    with stage('scale'):
+        im = scale_preview(im, get_preview_scale(label_size[0], preview_options) / draft_scale)
+    with stage('encode'):
+        preview = image_to_preview_bytes(
+            im,
+            preview_options['image_format'],
+            current_app.config['PREVIEW_COMPRESS_LEVEL'],
+            current_app.config['PREVIEW_WEBP_QUALITY'])
+    if return_format == 'base64':
+        preview = base64.b64encode(preview)
+    return preview, label_size
+
+
+@bp.route('/api/stats', methods=['GET'])
+def get_stats():
+    return {
+        'preview_cache': PREVIEW_CACHE.stats(),
+        'preview_coalescer': PREVIEW_COALESCER.stats(),
+        'font_pool': FONT_POOL.stats(),
+        'uploads': UPLOADS.stats(),
+        'printers': {printer.device_specifier: printer.connection.stats()
+                     for printer in printer_queues()}
+    }
+
+
+def collect_metrics():
+    """ Metric families of the caches, print queues and printers for /metrics """
+    caches = {
+        'preview': PREVIEW_CACHE.stats(),
+        'font_pool': FONT_POOL.stats(),
+        'upload_files': UPLOADS.files.stats(),
+        'upload_bitmaps': UPLOADS.bitmaps.stats()
+    }
+
+    def cache_samples(key):
+        return [('', {'cache': name}, stats[key]) for name, stats in caches.items()]
+
+    jobs = Counter(job.state.value for job in PRINT_JOBS.jobs())
+    load = PRINT_JOBS.load()
+    printers = [(printer, printer.queue.connection.stats()) for printer in PRINTER_POOL.printers()]
+
+    def printer_samples(value):
+        return [('', {'printer': printer.name, 'device_specifier': printer.queue.device_specifier}, value(printer, stats))
+                for printer, stats in printers]
+
+    coalescer = PREVIEW_COALESCER.stats()
+
+    return [
+        format_family('previews_rendered_total', 'counter', 'Previews which were rendered',
+                      [('', {}, coalescer['renders'])]),
+        format_family('previews_superseded_total', 'counter',
+                      'Previews skipped because a newer preview of the same client arrived',
+                      [('', {}, coalescer['superseded'])]),
+        format_family('cache_hits_total', 'counter', 'Cache hits', cache_samples('hits')),
+        format_family('cache_misses_total', 'counter', 'Cache misses', cache_samples('misses')),
+        format_family('cache_evictions_total', 'counter', 'Cache evictions', cache_samples('evictions')),
+        format_family('cache_hit_ratio', 'gauge', 'Cache hits per lookup', cache_samples('hit_rate')),
+        format_family('cache_size', 'gauge',
+                      'Size of the cache, in bytes or entries for the font pool', cache_samples('size')),
+        format_family('print_jobs', 'gauge', 'Print jobs kept in the job history by state',
+                      [('', {'state': state}, count) for state, count in jobs.items()]),
+        format_family('print_queue_depth', 'gauge', 'Print jobs waiting for the printer',
+                      [('', {'device_specifier': device_specifier}, depth)
+                       for device_specifier, depth in PRINT_JOBS.queue_depth().items()]),
+        format_family('print_queued_labels', 'gauge', 'Labels of the unfinished print jobs',
+                      printer_samples(lambda printer, stats: load.get(printer.queue.device_specifier, 0))),
+        format_family('printer_bytes_written_total', 'counter', 'Bytes written to the printer',
+                      printer_samples(lambda printer, stats: stats['bytes_written'])),
+        format_family('printer_connects_total', 'counter', 'Connections opened to the printer',
+                      printer_samples(lambda printer, stats: stats['connects'])),
+        format_family('printer_reconnects_total', 'counter', 'Reconnections after stale or failed connections',
+                      printer_samples(lambda printer, stats: stats['reconnects'])),
+        format_family('printer_failures_total', 'counter', 'Failed writes to the printer',
+                      printer_samples(lambda printer, stats: printer.failures)),
+        format_family('printer_available', 'gauge', '1 if the printer is used by the dispatch',
+                      printer_samples(lambda printer, stats: printer.available(PRINTER_POOL.retry_delay))),
+    ]
+
+
+REGISTRY.register_collector('labeldesigner', collect_metrics)
+
+
+@bp.route('/api/printers', methods=['GET'])
+def get_printers():
+    return PRINTER_POOL.status(PRINT_JOBS.load())
 
 
 @bp.route('/api/print', methods=['POST', 'GET'])
@@ -71,7 +318,9 @@ def print_text():
     """
     API to print a label
 
-    returns: JSON
+    The label is rendered and sent to the printer in the background.
+
+    returns: JSON with the id of the print job, see /api/jobs/<job_id>
 
     Ideas for additional URL parameters:
     - alignment
@@ -80,48 +329,444 @@ def print_text():
     return_dict = {'success': False}
 
     try:
-        printer = create_printer_from_request(request)
-        label = create_label_from_request(request)
+        job = create_job_from_request(request)
+        with stage('label'):
+            labels = create_labels_from_request(request)
+        label_size = request.values.get('label_size', '62')
         print_count = int(request.values.get('print_count', 1))
         cut_once = int(request.values.get('cut_once', 0)) == 1
+        for label in labels:
+            job.add_label(label, label_size, print_count, cut_once)
+        PRINT_JOBS.submit(job)
+    except MissingUpload as e:
+        return_dict['message'] = str(e)
+        return return_dict, 400
     except Exception as e:
         return_dict['message'] = str(e)
         current_app.logger.error('Exception happened: %s', e)
         return return_dict
 
-    printer.add_label_to_queue(label, print_count, cut_once)
+    return_dict['success'] = True
+    return_dict['job_id'] = job.id
+    return return_dict
+
+
+@bp.route('/api/print/batch', methods=['POST'])
+def print_batch():
+    """
+    API to print many different labels in a single print job
+
+    Expects a JSON array with one object of label parameters per label or
+    a CSV file (form field 'data') with the parameter names in its header.
+    Form and URL parameters are used as defaults for every label.
+
+    returns: JSON with the id of the print job and the errors per item
+    """
+
+    return_dict = {'success': False, 'errors': []}
 
     try:
-        printer.process_queue()
+        job = create_job_from_request(request)
+        items = get_batch_items(request)
     except Exception as e:
         return_dict['message'] = str(e)
         current_app.logger.error('Exception happened: %s', e)
         return return_dict
 
+    for index, values in enumerate(items):
+        try:
+            for label in create_labels_from_values(values):
+                job.add_label(
+                    label,
+                    values.get('label_size', '62'),
+                    int(values.get('print_count', 1)),
+                    int(values.get('cut_once', 0)) == 1,
+                    item=index)
+        except Exception as e:
+            return_dict['errors'].append({'item': index, 'message': str(e)})
+
+    if not job.entries:
+        return_dict['message'] = 'No printable labels found'
+        return return_dict
+
+    try:
+        PRINT_JOBS.submit(job)
+    except LookupError as e:
+        return_dict['message'] = str(e)
+        return return_dict
+
     return_dict['success'] = True
+    return_dict['job_id'] = job.id
     return return_dict
 
 
-def create_printer_from_request(request):
-    d = request.values
-    context = {
-        'label_size': d.get('label_size', '62')
+@bp.route('/api/templates', methods=['GET'])
+def get_templates():
+    return {'templates': LABEL_TEMPLATES.names()}
+
+
+@bp.route('/api/templates/<name>', methods=['GET'])
+def get_template(name):
+    parameters = LABEL_TEMPLATES.get(name)
+    if parameters is None:
+        abort(404)
+    return {
+        'name': name,
+        'parameters': parameters,
+        'placeholders': LabelTemplate(get_label_arguments(parameters)).placeholders
     }
 
-    return PrinterQueue(
-        model = current_app.config['PRINTER_MODEL'],
-        device_specifier = current_app.config['PRINTER_PRINTER'],
-        label_size = context['label_size']
-    )
 
+@bp.route('/api/templates/<name>', methods=['POST', 'PUT'])
+def save_template(name):
+    """
+    API to save a label template
+
+    Expects the label parameters as JSON object or form parameters. The text
+    may contain placeholders like {name}, which are filled per record when
+    the template is printed.
+
+    returns: JSON with the placeholders of the template
+    """
+
+    return_dict = {'success': False}
+
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict):
+        values = request.values.to_dict()
+    parameters = {key: values[key] for key in TEMPLATE_PARAMETERS if key in values}
+
+    try:
+        # fails for invalid parameters before the template is stored
+        template = LabelTemplate(get_label_arguments(parameters))
+        LABEL_TEMPLATES.save(name, parameters)
+    except Exception as e:
+        return_dict['message'] = str(e)
+        current_app.logger.error('Exception happened: %s', e)
+        return return_dict
+
+    return_dict['success'] = True
+    return_dict['placeholders'] = template.placeholders
+    return return_dict
+
+
+@bp.route('/api/templates/<name>', methods=['DELETE'])
+def delete_template(name):
+    if not LABEL_TEMPLATES.delete(name):
+        abort(404)
+    return {'success': True}
+
+
+@bp.route('/api/templates/<name>/print', methods=['POST'])
+def print_template(name):
+    """
+    API to print a label template once per record
+
+    Expects a JSON array with one object per record or a CSV file (form
+    field 'data') whose columns fill the placeholders of the template.
+    A print_count field of a record overrides the print_count parameter.
+
+    returns: JSON with the id of the print job and the errors per record
+    """
+
+    return_dict = {'success': False, 'errors': []}
+
+    parameters = LABEL_TEMPLATES.get(name)
+    if parameters is None:
+        abort(404)
+
+    try:
+        job = create_job_from_request(request)
+        # the layout of the template is parsed once for all records
+        template = LabelTemplate(get_label_arguments(parameters))
+        records = get_records(request)
+        label_size = parameters.get('label_size', '62')
+        print_count = int(request.values.get('print_count', 1))
+        cut_once = int(request.values.get('cut_once', 0)) == 1
+    except Exception as e:
+        return_dict['message'] = str(e)
+        current_app.logger.error('Exception happened: %s', e)
+        return return_dict
+
+    for index, record in enumerate(records):
+        try:
+            job.add_label(
+                template.create_label(record),
+                label_size,
+                int(record.get('print_count') or print_count),
+                cut_once,
+                item=index)
+        except Exception as e:
+            return_dict['errors'].append({'item': index, 'message': str(e)})
+
+    if not job.entries:
+        return_dict['message'] = 'No printable labels found'
+        return return_dict
+
+    try:
+        PRINT_JOBS.submit(job)
+    except LookupError as e:
+        return_dict['message'] = str(e)
+        return return_dict
+
+    return_dict['success'] = True
+    return_dict['job_id'] = job.id
+    return return_dict
+
+
+@bp.route('/api/export', methods=['POST', 'GET'])
+def export_raster():
+    """
+    API to render labels to the raster instructions of the printer without
+    printing them
+
+    Takes the parameters of /api/print. The raster file is stored in the
+    spool, see /api/spool, for the printer model given by model or of the
+    printer the labels would be printed on (see printer).
 
-def create_label_from_request(request):
-    d=request.values
-    context={
+    Optional parameters:
+    - name: name of the raster file, generated if missing
+    - compress: 1 to compress the raster lines, if the model supports it
+    - download: 1 to return the raster file instead of its metadata
+
+    returns: JSON with the metadata of the raster file
+    """
+
+    return_dict = {'success': False}
+
+    try:
+        with stage('label'):
+            labels = create_labels_from_request(request)
+        label_size = request.values.get('label_size', '62')
+        print_count = int(request.values.get('print_count', 1))
+        cut_once = int(request.values.get('cut_once', 0)) == 1
+        entries = []
+        for label in labels:
+            entries += queue_entries(label, label_size, print_count, cut_once)
+        metadata, errors = export_raster_file(request.values, entries)
+        if errors:
+            raise errors[0][1]
+    except MissingUpload as e:
+        return_dict['message'] = str(e)
+        return return_dict, 400
+    except Exception as e:
+        return_dict['message'] = str(e)
+        current_app.logger.error('Exception happened: %s', e)
+        return return_dict
+
+    if int(request.values.get('download', 0)) == 1:
+        return send_raster_file(metadata['name'])
+
+    return_dict['success'] = True
+    return_dict['raster'] = metadata
+    return return_dict
+
+
+@bp.route('/api/export/batch', methods=['POST'])
+def export_raster_batch():
+    """
+    API to render many different labels into a single raster file, takes the
+    parameters of /api/print/batch and /api/export
+
+    returns: JSON with the metadata of the raster file and the errors per item
+    """
+
+    return_dict = {'success': False, 'errors': []}
+
+    try:
+        items = get_batch_items(request)
+    except Exception as e:
+        return_dict['message'] = str(e)
+        current_app.logger.error('Exception happened: %s', e)
+        return return_dict
+
+    entries = []
+    item_of_label = {}
+    for index, values in enumerate(items):
+        try:
+            for label in create_labels_from_values(values):
+                item_of_label[id(label)] = index
+                entries += queue_entries(
+                    label,
+                    values.get('label_size', '62'),
+                    int(values.get('print_count', 1)),
+                    int(values.get('cut_once', 0)) == 1)
+        except Exception as e:
+            return_dict['errors'].append({'item': index, 'message': str(e)})
+
+    try:
+        metadata, errors = export_raster_file(request.values, entries)
+    except Exception as e:
+        return_dict['message'] = str(e)
+        current_app.logger.error('Exception happened: %s', e)
+        return return_dict
+    for label, e in errors:
+        return_dict['errors'].append({'item': item_of_label[id(label)], 'message': str(e)})
+
+    return_dict['success'] = True
+    return_dict['raster'] = metadata
+    return return_dict
+
+
+@bp.route('/api/spool', methods=['GET'])
+def get_raster_files():
+    return {'rasters': [metadata for metadata in map(RASTER_SPOOL.get, RASTER_SPOOL.names())
+                        if metadata is not None]}
+
+
+@bp.route('/api/spool/<name>', methods=['GET'])
+def get_raster_file(name):
+    return send_raster_file(name)
+
+
+@bp.route('/api/spool/<name>', methods=['DELETE'])
+def delete_raster_file(name):
+    if not RASTER_SPOOL.delete(name):
+        abort(404)
+    return {'success': True}
+
+
+@bp.route('/api/spool/<name>/print', methods=['POST'])
+def print_raster_file(name):
+    """
+    API to print a raster file of the spool as it is, without rendering the
+    labels again. It is sent to a printer of the model it was rendered for.
+
+    returns: JSON with the id of the print job
+    """
+
+    return_dict = {'success': False}
+
+    metadata = RASTER_SPOOL.get(name)
+    if metadata is None:
+        abort(404)
+
+    try:
+        job = RasterJob(
+            functools.partial(RASTER_SPOOL.iter_chunks, name),
+            metadata,
+            int(request.values.get('print_count', 1)),
+            pool=PRINTER_POOL,
+            printer_name=request.values.get('printer') or None)
+        PRINT_JOBS.submit(job)
+    except Exception as e:
+        return_dict['message'] = str(e)
+        current_app.logger.error('Exception happened: %s', e)
+        return return_dict
+
+    return_dict['success'] = True
+    return_dict['job_id'] = job.id
+    return return_dict
+
+
+@bp.route('/api/jobs', methods=['GET'])
+def get_jobs():
+    return {
+        'queue_depth': PRINT_JOBS.queue_depth(),
+        'jobs': [job.to_dict() for job in PRINT_JOBS.jobs()]
+    }
+
+
+@bp.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = PRINT_JOBS.get(job_id)
+    if job is None:
+        abort(404)
+    return job.to_dict()
+
+
+def create_job_from_request(request):
+    """ The job is routed to a printer of the pool with its label sizes when
+    it is submitted, the printer parameter selects a printer by name
+    """
+    return PrintJob(pool=PRINTER_POOL, printer_name=request.values.get('printer') or None)
+
+
+def export_raster_file(values, entries):
+    """ Renders the queue entries and stores their raster instructions in the spool
+    :param values: the export parameters name, model, printer and compress
+    :return: the metadata of the raster file and the list of (label, exception)
+        of the labels which failed to render
+    """
+    if not entries:
+        raise ValueError('No printable labels found')
+
+    label_sizes = sorted({entry['label_size'] for entry in entries})
+    model = values.get('model') or PRINTER_POOL.route(label_sizes, name=values.get('printer') or None).model
+    if model not in PRINTER_MODELS:
+        raise ValueError('Unknown printer model {}'.format(model))
+    name = values.get('name') or RASTER_SPOOL.new_name()
+    # validates the name before the labels are rendered
+    RASTER_SPOOL.path(name)
+
+    errors = []
+    metadata = {
+        'model': model,
+        'label_sizes': label_sizes,
+        'labels': 0,
+        'compressed': int(values.get('compress', 0)) == 1
+    }
+
+    def count_labels(chunks):
+        for chunk in chunks:
+            metadata['labels'] += 1
+            yield chunk
+
+    # the metadata is stored after the last label was written
+    metadata = RASTER_SPOOL.save(name, count_labels(iter_raster(
+        model, entries, PRINT_JOBS.executor, errors,
+        current_app.config['RENDER_PREFETCH'], metadata['compressed'])), metadata)
+    if not metadata['labels']:
+        RASTER_SPOOL.delete(name)
+        raise errors[0][1]
+    return metadata, errors
+
+
+def send_raster_file(name):
+    try:
+        path = RASTER_SPOOL.path(name)
+    except ValueError:
+        abort(404)
+    if RASTER_SPOOL.get(name) is None or not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True, download_name=name + '.bin')
+
+
+def get_batch_items(request):
+    """ Reads the label parameter sets of a batch from a JSON array or an
+    uploaded CSV file
+    :return: list of dicts, merged with the parameters of the request
+    """
+    defaults = request.values.to_dict()
+    # empty cells fall back to the defaults
+    return [dict(defaults, **item) for item in get_records(request, skip_empty_cells=True)]
+
+
+def get_records(request, skip_empty_cells=False):
+    """ Reads records from a JSON array or an uploaded CSV file (form field 'data')
+    :param skip_empty_cells: leave out the empty cells of a CSV row
+    :return: list of dicts
+    """
+    if 'data' in request.files:
+        reader = csv.DictReader(
+            io.TextIOWrapper(request.files['data'].stream, encoding='utf-8-sig'))
+        # cells beyond the header are collected under the key None
+        items = [{key: value or '' for key, value in row.items()
+                  if key is not None and not (skip_empty_cells and value in ('', None))}
+                 for row in reader]
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError('Expected a JSON array of label parameters or a CSV file')
+
+    return items
+
+
+def get_label_context(d):
+    return {
         'label_size': d.get('label_size', '62'),
         'print_type': d.get('print_type', 'text'),
         'label_orientation': d.get('orientation', 'standard'),
-        'kind': label_type_specs[d.get('label_size', "62")]['kind'],
         'margin_top': float(d.get('margin_top', 24))/100.,
         'margin_bottom': float(d.get('margin_bottom', 45))/100.,
         'margin_left': float(d.get('margin_left', 35))/100.,
@@ -135,38 +780,190 @@ def create_label_from_request(request):
         'font_family': d.get('font_family'),
         'font_style': d.get('font_style'),
         'print_color': d.get('print_color', 'black'),
+        'image_dither': d.get('image_dither', current_app.config['IMAGE_DITHER']),
+        'pdf_pages': d.get('pdf_pages', '1'),
     }
 
-    def get_label_dimensions(label_size):
-        try:
-            ls = label_type_specs[context['label_size']]
-        except KeyError:
-            raise LookupError("Unknown label_size")
-        return ls['dots_printable']
 
-    def get_font_path(font_family_name, font_style_name):
-        try:
-            if font_family_name is None or font_style_name is None:
-                font_family_name = current_app.config['LABEL_DEFAULT_FONT_FAMILY']
-                font_style_name = current_app.config['LABEL_DEFAULT_FONT_STYLE']
-            font_path = FONTS.fonts[font_family_name][font_style_name]
-        except KeyError:
-            raise LookupError("Couln't find the font & style")
-        return font_path
-
-    def get_uploaded_image(image):
-        try:
-            name, ext = os.path.splitext(image.filename)
-            if ext.lower() in ('.png', '.jpg', '.jpeg'):
-                image = imgfile_to_image(image)
-                return convert_image_to_bw(image, 200)
-            elif ext.lower() in ('.pdf'):
-                image = pdffile_to_image(image, DEFAULT_DPI)
-                return convert_image_to_bw(image, 200)
-            else:
-                return None
-        except AttributeError:
+def get_font_path(font_family_name, font_style_name):
+    try:
+        if font_family_name is None or font_style_name is None:
+            font_family_name = current_app.config['LABEL_DEFAULT_FONT_FAMILY']
+            font_style_name = current_app.config['LABEL_DEFAULT_FONT_STYLE']
+        font_path = FONTS.fonts[font_family_name][font_style_name]
+    except KeyError:
+        raise LookupError("Couln't find the font & style")
+    return font_path
+
+
+def get_preview_options(values):
+    options = {
+        'scale': float(values.get('scale', 1)),
+        'max_width': int(values.get('max_width', 0)),
+        'draft': int(values.get('draft', 0)) == 1,
+        'image_format': values.get('image_format', 'png'),
+    }
+    if not 0 < options['scale'] <= 1:
+        raise ValueError("scale must be between 0 and 1")
+    if options['image_format'] not in PREVIEW_FORMATS:
+        raise LookupError("Unknown image_format")
+    return options
+
+
+def get_preview_scale(width, options):
+    """ :return: the factor the preview of a label with the given width is scaled by """
+    scale = options['scale']
+    if options['max_width'] and width > options['max_width']:
+        scale = min(scale, options['max_width'] / width)
+    return scale
+
+
+def get_preview_cache_key(request, return_format, preview_options):
+    """ Builds a content hash over everything that influences the rendered preview
+    :return: hex digest which is used as cache key and ETag
+    """
+    context = get_label_context(request.values)
+    font_path = get_font_path(context['font_family'], context['font_style'])
+
+    image = request.files.get('image', None)
+    if image is not None:
+        # same digest as the token of an upload
+        image_digest = hashlib.sha256(image.stream.read()).hexdigest()
+        image.stream.seek(0)
+    else:
+        image_digest = request.values.get('image_token') or None
+
+    key = json.dumps({
+        'context': context,
+        'font_path': font_path,
+        'font_mtime': os.path.getmtime(font_path),
+        'image': image_digest,
+        'return_format': return_format,
+        'preview': preview_options
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def get_upload(values, image=None):
+    """ :return: the Upload of the uploaded image file or of the image_token parameter """
+    if image is not None:
+        return UPLOADS.get(UPLOADS.store(image))
+    if values.get('image_token'):
+        upload = UPLOADS.get(values['image_token'])
+        if upload is None:
+            raise MissingUpload("Unknown image_token, please upload the image again")
+        return upload
+    return None
+
+
+def get_pdf_pages(values, upload):
+    """ :return: the pages selected by pdf_pages if a PDF is printed, None otherwise """
+    if values.get('print_type') != 'image' or upload is None:
+        return None
+    if os.path.splitext(upload.filename)[1].lower() != '.pdf':
+        return None
+    # pdfinfo runs once per upload, not for every preview and print
+    if upload.page_count is None:
+        upload.page_count = pdffile_page_count(upload)
+    return parse_page_range(values.get('pdf_pages', '1'), upload.page_count)
+
+
+def convert_uploaded_image(upload, dither, max_size, page=1):
+    name, ext = os.path.splitext(upload.filename)
+    if ext.lower() in ('.png', '.jpg', '.jpeg'):
+        image = imgfile_to_image(upload)
+    elif ext.lower() == '.pdf':
+        # render the page straight at the printable width
+        width = max_size[0] if max_size[0] < sys.maxsize else None
+        image = pdffile_to_image(upload, DEFAULT_DPI, page, width)
+    else:
+        return None
+    return convert_image_to_bw(image, 200, dither, max_size)
+
+
+def create_preview_label(request, preview_options):
+    """ Creates the label for the preview, of a PDF the first page of pdf_pages is shown
+    :return: the label and the scale it is rendered at
+    """
+    upload = get_upload(request.values, request.files.get('image', None))
+    pages = get_pdf_pages(request.values, upload)
+    arguments = get_label_arguments(request.values, upload, pages[0] if pages else 1)
+
+    scale = 1
+    # the width of rotated endless labels depends on their content, they are scaled afterwards
+    if preview_options['draft'] and arguments['width']:
+        scale = get_preview_scale(arguments['width'], preview_options)
+        if scale < 1:
+            arguments = scale_label_arguments(arguments, scale)
+    return SimpleLabel(**arguments), scale
+
+
+def scale_label_arguments(arguments, scale):
+    """ Scales the label down for a draft preview, rendered with anti-aliasing """
+    image = arguments['image']
+    if image is not None:
+        image = scale_preview(image, scale)
+    return dict(
+        arguments,
+        width=round(arguments['width'] * scale),
+        height=round(arguments['height'] * scale),
+        label_margin=tuple(round(margin * scale) for margin in arguments['label_margin']),
+        font_size=max(round(arguments['font_size'] * scale), 1),
+        qr_size=max(round(arguments['qr_size'] * scale), 1),
+        image=image,
+        render_mode=RenderMode.RGB if arguments['render_mode'] == RenderMode.BLACK_RED else RenderMode.GREY)
+
+
+def create_labels_from_request(request):
+    return create_labels_from_values(request.values, request.files.get('image', None))
+
+
+def create_labels_from_values(values, image=None):
+    """ Creates one label per page of pdf_pages if a PDF is printed, one label otherwise
+    :param image: uploaded image file, otherwise the image_token parameter is used
+    """
+    upload = get_upload(values, image)
+    if values.get('print_type') == 'image' and upload is None:
+        raise MissingUpload("No image uploaded")
+    pages = get_pdf_pages(values, upload)
+    if not pages:
+        return [create_label_from_values(values, upload)]
+    if len(pages) == 1:
+        return [create_label_from_values(values, upload, pages[0])]
+    # the pages are rasterized one by one while the job is printed
+    return [create_label_from_values(values, upload, page, lazy=True) for page in pages]
+
+
+def create_label_from_values(values, upload=None, page=1, lazy=False):
+    return SimpleLabel(**get_label_arguments(values, upload, page, lazy))
+
+
+def get_label_arguments(values, upload=None, page=1, lazy=False):
+    """ Parses the label parameters
+    :param upload: Upload of the image, otherwise the image_token parameter is used
+    :param page: page of a PDF which is printed
+    :param lazy: rasterize the image when the label is generated instead of now
+    :return: the keyword arguments of SimpleLabel
+    """
+    context = get_label_context(values)
+
+    if upload is None:
+        upload = get_upload(values)
+
+    def get_uploaded_image(upload, max_size):
+        if context['image_dither'] not in DITHER_MODES:
+            raise LookupError("Unknown image_dither")
+        if upload is None:
             return None
+        if lazy:
+            # not cached to keep the memory usage of long PDFs flat
+            return functools.partial(
+                convert_uploaded_image, upload, context['image_dither'], max_size, page)
+        # the decoded and converted bitmap is reused by all previews and prints of the upload
+        return UPLOADS.get_bitmap(
+            upload,
+            (context['image_dither'], max_size, page),
+            lambda upload: convert_uploaded_image(upload, context['image_dither'], max_size, page))
 
     if context['print_type'] == 'text':
         label_content = LabelContent.TEXT_ONLY
@@ -182,25 +979,22 @@ def create_label_from_request(request):
     else:
         label_orientation = LabelOrientation.STANDARD
 
-    if context['kind'] == ENDLESS_LABEL:
-        label_type = LabelType.ENDLESS_LABEL
-    elif context['kind'] == DIE_CUT_LABEL:
-        label_type = LabelType.DIE_CUT_LABEL
-    else:
-        label_type = LabelType.ROUND_DIE_CUT_LABEL
+    geometry = get_label_geometry(context['label_size'], label_orientation)
+    width, height = geometry.width, geometry.height
 
-    width, height = get_label_dimensions(context['label_size'])
-    if height > width:
-        width, height = height, width
-    if label_orientation == LabelOrientation.ROTATED:
-        height, width = width, height
+    if current_app.config['LABEL_RENDER_MODE'] == 'rgb':
+        render_mode = RenderMode.RGB
+    elif geometry.red:
+        render_mode = RenderMode.BLACK_RED
+    else:
+        render_mode = RenderMode.BLACK
 
-    return SimpleLabel(
+    return dict(
         width=width,
         height=height,
         label_content=label_content,
         label_orientation=label_orientation,
-        label_type=label_type,
+        label_type=geometry.label_type,
         label_margin=(
             int(context['font_size']*context['margin_left']),
             int(context['font_size']*context['margin_right']),
@@ -208,14 +1002,17 @@ def create_label_from_request(request):
             int(context['font_size']*context['margin_bottom'])
         ),
         fore_color=
-            (255, 0, 0) if 'red' in context['label_size'] and context['print_color'] == 'red'
+            (255, 0, 0) if geometry.red and context['print_color'] == 'red'
             else (0, 0, 0),
         text=context['text'],
         text_align=context['align'],
         qr_size=context['qrcode_size'],
         qr_correction=context['qrcode_correction'],
-        image=get_uploaded_image(request.files.get('image', None)),
+        # scale uploaded images down to the printable area, endless labels
+        # have no limit along the feed direction
+        image=get_uploaded_image(upload, (width or sys.maxsize, height or sys.maxsize)),
         font_path=get_font_path(context['font_family'], context['font_style']),
         font_size=context['font_size'],
-        line_spacing=context['line_spacing']
+        line_spacing=context['line_spacing'],
+        render_mode=render_mode
     )
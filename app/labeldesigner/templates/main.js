@@ -1,3 +1,11 @@
+var imageToken = null;
+var printing = false;
+var previewSequence = 0;
+// identifies this page to the server, which skips its previews once newer ones arrived
+var previewClientId = Math.random().toString(36).slice(2) + Date.now().toString(36);
+var previewTimer = null;
+var previewRequests = [];
+
 function formData(cut_once) {
     var text = $('#labelText').val();
     if (text == '') text = ' ';
@@ -19,17 +27,24 @@ function formData(cut_once) {
         print_count:       $('#printCount').val(),
         print_color:       $('input[name=printColor]:checked').val(),
         line_spacing:      $('input[name=lineSpacing]:checked').val(),
+        image_dither:      $('#imageDither option:selected').val(),
+        image_token:       imageToken,
+        pdf_pages:         $('#pdfPages').val(),
         cut_once:          cut_once ? 1 : 0,
+        printer:           $('#printer').val() || '',
     }
 }
 
-function updatePreview(data) {
+function updatePreview(data, xhr) {
     $('#previewImg').attr('src', 'data:image/png;base64,' + data);
-    var img = $('#previewImg')[0];
-    img.onload = function() {
-        $('#labelWidth').html( (img.naturalWidth /{{default_dpi}}*2.54).toFixed(1));
-        $('#labelHeight').html((img.naturalHeight/{{default_dpi}}*2.54).toFixed(1));
-    };
+    if (!xhr) {
+        $('#labelWidth').html('?');
+        $('#labelHeight').html('?');
+        return;
+    }
+    // the preview is scaled down, the size of the printed label is sent separately
+    $('#labelWidth').html( (xhr.getResponseHeader('X-Label-Width') /{{default_dpi}}*2.54).toFixed(1));
+    $('#labelHeight').html((xhr.getResponseHeader('X-Label-Height')/{{default_dpi}}*2.54).toFixed(1));
 }
 
 function updateStyles() {
@@ -86,51 +101,107 @@ function preview() {
         $('#groupLabelImage').hide();
     }
 
-    if($('input[name=printType]:checked').val() == 'image') {
-        dropZoneMode = 'preview';
-        imageDropZone.processQueue();
+    updatePrintButton();
+
+    if($('input[name=printType]:checked').val() == 'image' && imageToken == null) {
+        // the preview is updated once the image is uploaded
         return;
     }
 
-    $.ajax({
-        type:        'POST',
-        url:         '{{url_for('.get_preview_from_image')}}?return_format=base64',
-        contentType: 'application/x-www-form-urlencoded; charset=UTF-8',
-        data:        formData(),
-        success: function( data ) {
-            updatePreview(data);
-        }
+    // wait until the input settles instead of rendering every keystroke
+    clearTimeout(previewTimer);
+    previewTimer = setTimeout(requestPreview, 150);
+}
+
+function requestPreview() {
+    var data = formData();
+    // no need for more pixels than the preview pane shows
+    data['max_width'] = Math.round($('#previewImg').parent().width() * (window.devicePixelRatio || 1));
+
+    // previews of older input are not needed anymore
+    $.each(previewRequests, function(index, request) { request.abort(); });
+
+    // a fast draft is shown first and replaced by the exact preview
+    var sequence = ++previewSequence;
+    var done = false;
+    previewRequests = $.map([1, 0], function(draft) {
+        return $.ajax({
+            type:        'POST',
+            url:         '{{url_for('.get_preview_from_image')}}?return_format=base64',
+            contentType: 'application/x-www-form-urlencoded; charset=UTF-8',
+            data:        $.extend({draft: draft, client_id: previewClientId, seq: sequence}, data),
+            success: function( result, status, xhr ) {
+                if (sequence != previewSequence || done) return;
+                done = !draft;
+                updatePreview(result, xhr);
+            },
+            error: function( xhr, status ) {
+                // aborted or superseded (409) by a newer preview
+                if (status == 'abort' || xhr.status == 409) return;
+                // the server might have dropped the upload, send it again
+                if (!draft && imageToken != null && imageDropZone.files.length > 0) {
+                    imageToken = null;
+                    updatePrintButton();
+                    uploadImage(imageDropZone.files[0]);
+                }
+            }
+        });
     });
 }
 
+function updatePrintButton() {
+    // image labels can't be printed before the image is uploaded
+    var disabled = printing || ($('input[name=printType]:checked').val() == 'image' && imageToken == null);
+    $('#printButton').prop('disabled', disabled);
+    $('#dropdownPrintButton').prop('disabled', disabled);
+}
+
 function setStatus(data) {
     if (data['success']) {
         $('#statusPanel').html('<div id="statusBox" class="alert alert-success" role="alert"><i class="fas fa-check"></i><span>Printing was successful.</span></div>');
     } else {
         $('#statusPanel').html('<div id="statusBox" class="alert alert-warning" role="alert"><i class="fas fa-exclamation-triangle"></i><span>Printing was unsuccessful:<br />'+data['message']+'</span></div>');
     }
-    $('#printButton').prop('disabled', false);
-    $('#dropdownPrintButton').prop('disabled', false);
+    printing = false;
+    updatePrintButton();
 }
 
-function print(cut_once = false) {
-    $('#printButton').prop('disabled', true);
-    $('#dropdownPrintButton').prop('disabled', true);
-    $('#statusPanel').html('<div id="statusBox" class="alert alert-info" role="alert"><i class="fas fa-hourglass-half"></i><span>Processing print request...</span></div>');
-
-    if($('input[name=printType]:checked').val() == 'image') {
-        dropZoneMode = 'print';
-        imageDropZone.processQueue();
+function waitForJob(data) {
+    // The print request only queues the job, poll its state until it is finished
+    if (!data['success']) {
+        setStatus(data);
         return;
     }
 
+    $.ajax({
+        type:     'GET',
+        dataType: 'json',
+        url:      '{{url_for('.get_jobs')}}/' + data['job_id'],
+        success:  function( job ) {
+            if (job['state'] == 'done' || job['state'] == 'failed') {
+                setStatus({success: job['state'] == 'done', message: job['message']});
+            } else {
+                setTimeout(function() { waitForJob(data); }, 500);
+            }
+        },
+        error:    setStatus
+    });
+}
+
+function print(cut_once = false) {
+    printing = true;
+    updatePrintButton();
+    $('#statusPanel').html('<div id="statusBox" class="alert alert-info" role="alert"><i class="fas fa-hourglass-half"></i><span>Processing print request...</span></div>');
+
     $.ajax({
         type:     'POST',
         dataType: 'json',
         data:     formData(cut_once),
         url:      '{{url_for('.print_text')}}',
-        success:  setStatus,
-        error:    setStatus
+        success:  waitForJob,
+        error:    function( xhr ) {
+            setStatus(xhr.responseJSON || {success: false, message: xhr.statusText});
+        }
     });
 }
 
@@ -139,14 +210,15 @@ preview()
 
 
 var imageDropZone;
+
+function uploadImage(file) {
+    file.status = Dropzone.QUEUED;
+    imageDropZone.processFile(file);
+}
+
 Dropzone.options.myAwesomeDropzone = {
-    url: function() {
-        if (dropZoneMode == 'preview') {
-            return "{{url_for('.get_preview_from_image')}}?return_format=base64";
-        } else {
-            return "{{url_for('.print_text')}}";
-        }
-    },
+    // the image is uploaded once, previews and prints reference it by its token
+    url: "{{url_for('.upload_image')}}",
     paramName: "image",
     acceptedFiles: 'image/png,image/jpeg,application/pdf',
     maxFiles: 1,
@@ -162,33 +234,25 @@ Dropzone.options.myAwesomeDropzone = {
         });
     },
 
-    sending: function(file, xhr, data) {
-        // append all parameters to the request
-        fd = formData(false);
-
-        $.each(fd, function(key, value){
-            data.append(key, value);
-        });
-    },
-
     success: function(file, response) {
-        // If preview or print was successfull update the previewpane or print status
-        if (dropZoneMode == 'preview') {
-            updatePreview(response);
+        // If the upload was successfull update the previewpane
+        if (response['success']) {
+            imageToken = response['token'];
+            preview();
         } else {
             setStatus(response);
         }
-        file.status = Dropzone.QUEUED;
     },
 
     accept: function(file, done) {
-        // If a valid file was added, perform the preview
+        // If a valid file was added, upload it
         done();
-        preview();
+        uploadImage(file);
     },
 
     removedfile: function(file) {
         file.previewElement.remove();
+        imageToken = null;
         preview();
         // Insert a dummy image
         updatePreview('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNgYAAAAAMAASsJTYQAAAAASUVORK5CYII=');
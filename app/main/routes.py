@@ -1,6 +1,13 @@
-from flask import redirect, url_for
+from flask import redirect, url_for, make_response
 from . import bp
+from app.metrics import REGISTRY
 
 @bp.route('/')
 def index():
-    return redirect(url_for('labeldesigner.index'))
\ No newline at end of file
+    return redirect(url_for('labeldesigner.index'))
+
+@bp.route('/metrics')
+def metrics():
+    response = make_response(REGISTRY.render())
+    response.headers.set('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+    return response
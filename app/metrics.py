@@ -0,0 +1,172 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import g, request
+
+PREFIX = 'brother_ql_web_'
+
+# upper bounds in seconds, from cached previews up to printing long jobs
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# stage durations of the current request, None outside of requests (e.g. print workers)
+_timings = ContextVar('timings', default=None)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in labels.items()) + '}'
+
+
+def format_family(name, metric_type, help, samples):
+    """ Formats a metric family in the Prometheus text format
+    :param samples: iterable of (suffix, labels, value)
+    """
+    lines = ['# HELP {}{} {}'.format(PREFIX, name, help), '# TYPE {}{} {}'.format(PREFIX, name, metric_type)]
+    for suffix, labels, value in samples:
+        lines.append('{}{}{}{} {}'.format(PREFIX, name, suffix, format_labels(labels), float(value)))
+    return '\n'.join(lines)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            values = list(self._values.items())
+        return format_family(self.name, 'counter', self.help, [
+            ('', dict(zip(self.labelnames, key)), value) for key, value in values])
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # per label values: [count per bucket (+Inf last), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def collect(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append(('_bucket', dict(labels, le=bound), cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+        return format_family(self.name, 'histogram', self.help, samples)
+
+
+class Registry:
+    """ Metrics of the process, rendered at /metrics """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = {}
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, name, collector):
+        """ :param collector: callable returning formatted metric families, called on every scrape """
+        self._collectors[name] = collector
+
+    def render(self):
+        families = [metric.collect() for metric in self._metrics]
+        for collector in list(self._collectors.values()):
+            families.extend(collector())
+        return '\n'.join(families) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.register(Histogram(
+    'stage_duration_seconds', 'Duration of the stages of rendering and printing labels', ('stage',)))
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    'request_duration_seconds', 'Duration of the requests', ('endpoint',)))
+REQUESTS = REGISTRY.register(Counter(
+    'requests_total', 'Number of requests', ('endpoint', 'status')))
+
+
+@contextmanager
+def stage(name):
+    """ Measures a stage of a request or print job. Stages may be nested,
+    e.g. loading a font while the text is measured.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_DURATION.observe(duration, stage=name)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((name, duration))
+
+
+def server_timing(timings, total):
+    """ :return: value of the Server-Timing header, the durations of repeated stages are added up """
+    durations = {}
+    for name, duration in timings:
+        durations[name] = durations.get(name, 0) + duration
+    durations['total'] = total
+    return ', '.join('{};dur={:.2f}'.format(name, duration * 1000) for name, duration in durations.items())
+
+
+def init_app(app):
+    """ Records the duration and status of all requests and the stages of the
+    requests, sent in a Server-Timing header if SERVER_TIMING is enabled
+    """
+
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+        _timings.set([])
+
+    @app.after_request
+    def finish_request(response):
+        start = g.get('request_start')
+        if start is None:
+            return response
+        duration = time.perf_counter() - start
+        endpoint = request.endpoint or 'unknown'
+        REQUEST_DURATION.observe(duration, endpoint=endpoint)
+        REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+
+        timings = _timings.get()
+        _timings.set(None)
+        if app.config['SERVER_TIMING'] and timings:
+            response.headers.set('Server-Timing', server_timing(timings, duration))
+        return response
@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import uuid
+import threading
+
+from .label_templates import NAME_PATTERN
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class RasterSpool:
+    """ Stores rendered raster instructions as ready to send .bin files in a
+    folder, with their metadata (model, label sizes, ...) in a .json file
+    next to them
+    """
+
+    def __init__(self, folder):
+        """
+        :param folder: directory the raster files are stored in
+        """
+        self.folder = folder
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        """ :return: path of the raster file """
+        if not NAME_PATTERN.fullmatch(name):
+            raise ValueError('Invalid raster name, use letters, digits, spaces, - and _')
+        return os.path.join(self.folder, name + '.bin')
+
+    def _metadata_path(self, name):
+        return self.path(name)[:-len('.bin')] + '.json'
+
+    @staticmethod
+    def new_name():
+        return time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8]
+
+    def names(self):
+        try:
+            filenames = os.listdir(self.folder)
+        except OSError:
+            return []
+        return sorted(filename[:-len('.json')] for filename in filenames if filename.endswith('.json'))
+
+    def get(self, name):
+        """ :return: the metadata of the raster file or None if it doesn't exist """
+        try:
+            with open(self._metadata_path(name), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, name, chunks, metadata):
+        """ Writes the raster instructions as they are produced, the file only
+        appears in the spool once it is complete
+        :param chunks: iterable of bytes
+        :param metadata: dict stored with the file
+        :return: the stored metadata
+        """
+        path = self.path(name)
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            size = 0
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            metadata = dict(metadata, name=name, size=size, created=time.time())
+            with self._lock:
+                os.replace(tmp_path, path)
+                with open(self._metadata_path(name), 'w', encoding='utf-8') as f:
+                    json.dump(metadata, f, indent=2)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return metadata
+
+    def iter_chunks(self, name, chunk_size=CHUNK_SIZE):
+        """ Reads the raster file piece by piece, so long files are sent without
+        loading them into memory
+        """
+        with open(self.path(name), 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def delete(self, name):
+        """ :return: True if the raster file existed """
+        try:
+            with self._lock:
+                os.remove(self._metadata_path(name))
+        except (FileNotFoundError, ValueError):
+            return False
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+        return True
@@ -0,0 +1,138 @@
+import os
+import re
+import logging
+import hashlib
+import threading
+
+from .cache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+
+class MissingUpload(LookupError):
+    """ An image label without an uploaded image, or the upload is unknown """
+
+
+class Upload:
+    """ A stored upload, can be used like werkzeug's FileStorage by the image helpers """
+
+    def __init__(self, token, filename, data):
+        self.token = token
+        self.filename = filename
+        self.data = data
+        # number of pages of a PDF, counted on the first request
+        self.page_count = None
+
+    def save(self, dst):
+        dst.write(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class Uploads:
+    """ Keeps uploaded files by their content hash (token) in memory and
+    optionally on disk, and the black and white bitmaps converted from them
+    """
+
+    def __init__(self, max_size, bitmap_cache_size, folder='', folder_size=0):
+        """
+        :param max_size: upper bound in bytes for the uploads kept in memory
+        :param bitmap_cache_size: upper bound in bytes for the converted bitmaps
+        :param folder: directory the uploads are stored in, empty to keep them in memory only
+        :param folder_size: upper bound in bytes for the uploads stored in the folder
+        """
+        self.folder = folder
+        self.folder_size = folder_size
+        self.files = LRUCache(max_size)
+        # 1 bit per pixel, rows are padded to full bytes
+        self.bitmaps = LRUCache(bitmap_cache_size, sizeof=lambda im: (im.width + 7) // 8 * im.height)
+        self._lock = threading.Lock()
+
+    def store(self, file):
+        """ Stores an uploaded file
+        :param file: werkzeug FileStorage
+        :return: token referencing the upload
+        """
+        data = file.read()
+        token = hashlib.sha256(data).hexdigest()
+        _, ext = os.path.splitext(file.filename or '')
+        upload = Upload(token, token + ext.lower(), data)
+        self.files.set(token, upload)
+        if self.folder:
+            self._save(upload)
+        return token
+
+    def get(self, token):
+        """ :return: the Upload of the token or None if it is unknown """
+        if not TOKEN_PATTERN.fullmatch(token or ''):
+            return None
+        upload = self.files.get(token)
+        if upload is None and self.folder:
+            upload = self._load(token)
+            if upload is not None:
+                self.files.set(token, upload)
+        return upload
+
+    def get_bitmap(self, upload, key, convert):
+        """ Returns the converted bitmap of an upload, converting it on the first request
+        :param key: hashable parameters of the conversion
+        :param convert: function converting the Upload to the bitmap
+        """
+        cache_key = (upload.token, key)
+        bitmap = self.bitmaps.get(cache_key)
+        if bitmap is None:
+            bitmap = convert(upload)
+            if bitmap is not None:
+                self.bitmaps.set(cache_key, bitmap)
+        return bitmap
+
+    def _save(self, upload):
+        path = os.path.join(self.folder, upload.filename)
+        try:
+            with self._lock:
+                os.makedirs(self.folder, exist_ok=True)
+                if os.path.exists(path):
+                    # refresh the modification time, the oldest uploads are pruned first
+                    os.utime(path)
+                    return
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(upload.data)
+                os.replace(tmp_path, path)
+                self._prune()
+        except OSError as e:
+            logger.warning('Could not store the upload %s: %s', path, e)
+
+    def _load(self, token):
+        try:
+            for filename in os.listdir(self.folder):
+                name, _ = os.path.splitext(filename)
+                if name == token:
+                    with open(os.path.join(self.folder, filename), 'rb') as f:
+                        return Upload(token, filename, f.read())
+        except OSError as e:
+            logger.warning('Could not load the upload %s: %s', token, e)
+        return None
+
+    def _prune(self):
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.folder_size:
+                break
+            os.remove(path)
+            total -= size
+
+    def stats(self):
+        return {
+            'files': self.files.stats(),
+            'bitmaps': self.bitmaps.stats()
+        }
@@ -1,13 +1,77 @@
 # -*- coding: utf-8 -*-
 
-from PIL import Image
+from functools import lru_cache
+from PIL import Image, ImageChops
 from io import BytesIO
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_bytes, pdfinfo_from_bytes
 
+DITHER_NONE = 'none'
+DITHER_FLOYD_STEINBERG = 'floyd-steinberg'
+DITHER_ORDERED = 'ordered'
+DITHER_MODES = (DITHER_NONE, DITHER_FLOYD_STEINBERG, DITHER_ORDERED)
 
-def convert_image_to_bw(image, threshold):
-    fn = lambda x : 255 if x > threshold else 0
-    return image.convert('L').point(fn, mode='1') # convert to greyscale
+# greyscale previews are reduced to 4 levels (2 bit), enough for anti-aliased text
+GREY_LEVELS = [(x * 3 + 127) // 255 for x in range(256)]
+GREY_PALETTE = [value for level in range(4) for value in (level * 85,) * 3]
+
+BAYER_MATRIX = (
+    0, 32, 8, 40, 2, 34, 10, 42,
+    48, 16, 56, 24, 50, 18, 58, 26,
+    12, 44, 4, 36, 14, 46, 6, 38,
+    60, 28, 52, 20, 62, 30, 54, 22,
+    3, 35, 11, 43, 1, 33, 9, 41,
+    51, 19, 59, 27, 49, 17, 57, 25,
+    15, 47, 7, 39, 13, 45, 5, 37,
+    63, 31, 55, 23, 61, 29, 53, 21)
+
+
+@lru_cache(maxsize=16)
+def threshold_table(threshold):
+    """ Lookup table for Image.point() which maps grey values above the threshold to white """
+    return [255 if x > threshold else 0 for x in range(256)]
+
+
+def bayer_image(size):
+    """ Tiles the 8x8 Bayer matrix (scaled to grey values) over an image of the given size """
+    tile = Image.new('L', (8, 8))
+    tile.putdata([value * 4 + 2 for value in BAYER_MATRIX])
+
+    width, height = size
+    row = Image.new('L', (width, 8))
+    for x in range(0, width, 8):
+        row.paste(tile, (x, 0))
+    im = Image.new('L', size)
+    for y in range(0, height, 8):
+        im.paste(row, (0, y))
+    return im
+
+
+def convert_image_to_bw(image, threshold, dither=DITHER_NONE, max_size=None):
+    """ Converts the image to black and white
+    :param threshold: grey value above which pixels become white, unused when dithering
+    :param dither: one of DITHER_MODES
+    :param max_size: (width, height) the image is scaled down to before the conversion
+    """
+    size = image.size
+    if max_size is not None:
+        scale = min(max_size[0] / image.width, max_size[1] / image.height)
+        if scale < 1:
+            size = (max(round(image.width * scale), 1), max(round(image.height * scale), 1))
+            # lets the JPEG decoder scale down, has no effect on other formats
+            image.draft('L', size)
+
+    image = image.convert('L') # convert to greyscale
+    if image.size != size:
+        image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+    if dither == DITHER_FLOYD_STEINBERG:
+        return image.convert('1', dither=Image.FLOYDSTEINBERG)
+    elif dither == DITHER_ORDERED:
+        # white where the grey value exceeds the Bayer threshold, the difference is offset by 128
+        image = ImageChops.subtract(image, bayer_image(image.size), 1.0, 128)
+        return image.point(threshold_table(128), mode='1')
+    else:
+        return image.point(threshold_table(threshold), mode='1')
 
 
 def imgfile_to_image(file):
@@ -17,17 +81,81 @@ def imgfile_to_image(file):
     return im
 
 
-def pdffile_to_image(file, dpi):
+def pdffile_to_image(file, dpi, page=1, width=None):
+    """ Rasterizes a single page of the PDF in greyscale
+    :param page: number of the page, starting at 1
+    :param width: width in pixels the page is rendered to instead of using dpi
+    """
     s = BytesIO()
     file.save(s)
-    s.seek(0)
     im = convert_from_bytes(
-        s.read(),
-        dpi = dpi
+        s.getvalue(),
+        dpi = dpi,
+        first_page = page,
+        last_page = page,
+        size = (width, None) if width else None,
+        grayscale = True
     )[0]
     return im
 
 
+def pdffile_page_count(file):
+    s = BytesIO()
+    file.save(s)
+    return pdfinfo_from_bytes(s.getvalue())['Pages']
+
+
+def parse_page_range(value, page_count):
+    """ Parses a page range like '1-3,5' or '2-'
+    :param page_count: number of pages of the document
+    :return: list of the selected page numbers, starting at 1
+    """
+    pages = []
+    for part in value.replace(' ', '').split(','):
+        first, _, last = part.partition('-')
+        try:
+            first = int(first) if first else 1
+            last = (int(last) if last else page_count) if '-' in part else first
+        except ValueError:
+            raise ValueError("Invalid page range '{}'".format(value))
+        if not 1 <= first <= last <= page_count:
+            raise ValueError("Page range '{}' exceeds the {} page(s) of the PDF".format(value, page_count))
+        pages.extend(range(first, last + 1))
+    return pages
+
+
+def scale_preview(im, scale):
+    """ Scales the label down for the preview, black and white labels become greyscale
+    :param scale: factor between 0 and 1
+    """
+    size = (max(round(im.width * scale), 1), max(round(im.height * scale), 1))
+    if size == im.size:
+        return im
+    im = im.convert('RGB' if im.mode in ('P', 'RGB') else 'L')
+    return im.resize(size, Image.BOX, reducing_gap=1.0)
+
+
+def image_to_preview_bytes(im, image_format='png', compress_level=6, quality=80):
+    """ Encodes the preview. Greyscale and color previews are stored as indexed PNG
+    :param image_format: 'png' or 'webp'
+    :param compress_level: zlib compression level of PNG images
+    :param quality: quality of WebP images
+    """
+    image_buffer = BytesIO()
+    if image_format == 'webp':
+        im.save(image_buffer, format="WEBP", quality=quality, method=0)
+    elif im.mode == 'L':
+        indexed = Image.frombytes('P', im.size, im.point(GREY_LEVELS).tobytes())
+        indexed.putpalette(GREY_PALETTE)
+        indexed.save(image_buffer, format="PNG", compress_level=compress_level, bits=2)
+    elif im.mode == 'RGB':
+        im.quantize(16, Image.FASTOCTREE).save(
+            image_buffer, format="PNG", compress_level=compress_level, bits=4)
+    else:
+        im.save(image_buffer, format="PNG", compress_level=compress_level)
+    return image_buffer.getvalue()
+
+
 def image_to_png_bytes(im):
     image_buffer = BytesIO()
     im.save(image_buffer, format="PNG")
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark suite for the render, rasterize and encode hot paths.
+
+Text, QR code, QR code + text, image and PDF labels (PDF only if poppler is
+installed) are created for endless, die-cut, round and red label sizes in
+both orientations. Every case is run --rounds times:
+
+    render     creating the label from the request parameters and SimpleLabel.generate()
+    rasterize  the brother_ql conversion of the rendered label
+    print      PrinterQueue.process_queue() to a file:// backend in a temporary directory
+    encode     PNG and WebP encoding of previews
+    convert    convert_image_to_bw() of a photo and pdffile_to_image() of a PDF page
+
+Reports ops/s, p50/p99 latency and the growth of the peak resident memory per
+case. --save stores the results as JSON baseline, --compare shows the change
+of p50 against a baseline and exits with 1 if a case got slower than --tolerance.
+
+Usage: python -m benchmarks [--filter render/text] [--rounds 20]
+    [--save baseline.json] [--compare baseline.json] [--tolerance 0.1]
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from importlib import metadata
+from io import BytesIO
+
+from PIL import Image
+
+from app import create_app
+from app.uploads import Upload
+from app.utils import convert_image_to_bw, pdffile_to_image, image_to_png_bytes, image_to_preview_bytes
+from benchmarks.image_conversion import generate_photo
+
+LABEL_SIZES = ('62', '62x29', 'd24', '62red')
+ORIENTATIONS = ('standard', 'rotated')
+
+TEXT = 'Benchmark label\nSKU 0012345'
+QR_DATA = 'https://inventory.example.com/assets/000123?site=berlin'
+
+
+def label_values(content, label_size, orientation):
+    values = {'label_size': label_size, 'orientation': orientation, 'font_size': 70, 'text': TEXT}
+    if content == 'qr':
+        values.update(print_type='qrcode', text=QR_DATA)
+    elif content == 'qr_text':
+        values.update(print_type='qrcode_text', text=QR_DATA + '\n' + TEXT)
+    elif content in ('image', 'pdf'):
+        values['print_type'] = 'image'
+    if label_size.endswith('red'):
+        values['print_color'] = 'red'
+    return values
+
+
+def generate_pdf():
+    buffer = BytesIO()
+    page = Image.open(BytesIO(generate_photo((2480, 3508), 'JPEG')))
+    page.save(buffer, format='PDF', resolution=300)
+    return buffer.getvalue()
+
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    libc.malloc_trim
+except (OSError, AttributeError, TypeError):
+    libc = None
+
+
+def memory_status(field):
+    with open('/proc/self/status') as f:
+        return int(re.search(r'^{}:\s+(\d+) kB'.format(field), f.read(), re.MULTILINE).group(1)) * 1024
+
+
+def measure_peak_memory(fn):
+    """ Pillow allocates the image buffers outside of the Python allocator,
+    so the peak resident memory is used instead of tracemalloc
+    :return: growth of the peak resident memory in bytes while running fn,
+        None if the platform can't reset the peak
+    """
+    try:
+        # return the memory freed by earlier cases, otherwise it is reused
+        # without raising the peak
+        if libc is not None:
+            libc.malloc_trim(0)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        before = memory_status('VmRSS')
+    except OSError:
+        fn()
+        return None
+    fn()
+    return max(memory_status('VmHWM') - before, 0)
+
+
+def percentile(durations, fraction):
+    durations = sorted(durations)
+    return durations[min(len(durations) - 1, int(len(durations) * fraction))]
+
+
+def run_case(fn, rounds):
+    # the first run fills the font, QR code and bitmap caches like in a running server
+    peak_memory = measure_peak_memory(fn)
+    durations = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return {
+        'ops_per_sec': len(durations) / sum(durations),
+        'p50': statistics.median(durations),
+        'p99': percentile(durations, 0.99),
+        'peak_memory': peak_memory
+    }
+
+
+def create_cases(model, spool_dir):
+    """ :return: list of (name, callable) """
+    from app.labeldesigner.printer import PrinterQueue, rasterize_image
+    from app.labeldesigner.routes import create_label_from_values
+
+    photo = generate_photo((3000, 2000), 'JPEG')
+    uploads = {'image': Upload('', 'photo.jpg', photo)}
+    if shutil.which('pdftoppm'):
+        uploads['pdf'] = Upload('', 'page.pdf', generate_pdf())
+    else:
+        print('pdftoppm (poppler) not found, skipping the PDF cases\n')
+
+    cases = []
+    for content in ('text', 'qr', 'qr_text', 'image', 'pdf'):
+        if content in ('image', 'pdf') and content not in uploads:
+            continue
+        upload = uploads.get(content)
+        for label_size in LABEL_SIZES:
+            for orientation in ORIENTATIONS:
+                name = '{}/{}/{}'.format(content, label_size, orientation)
+                values = label_values(content, label_size, orientation)
+                label = create_label_from_values(values, upload)
+                image = label.generate()
+                # the file backend opens an existing file like a device node
+                path = os.path.join(spool_dir, name.replace('/', '_') + '.bin')
+                open(path, 'wb').close()
+                printer = PrinterQueue(model, 'file://' + path)
+
+                def print_label(label=label, label_size=label_size, printer=printer):
+                    printer.add_label_to_queue(label, label_size, 1)
+                    printer.process_queue()
+
+                cases += [
+                    ('render/' + name,
+                     lambda values=values, upload=upload: create_label_from_values(values, upload).generate()),
+                    ('rasterize/' + name,
+                     lambda label=label, image=image, label_size=label_size: rasterize_image(
+                         model, label, image, label_size, True)),
+                    ('print/' + name, print_label),
+                ]
+
+    preview = create_label_from_values(label_values('qr_text', '62', 'standard')).generate()
+    cases += [
+        ('encode/png', lambda: image_to_png_bytes(preview)),
+        ('encode/preview_png', lambda: image_to_preview_bytes(preview)),
+        ('encode/preview_webp', lambda: image_to_preview_bytes(preview, 'webp')),
+        ('convert/photo', lambda: convert_image_to_bw(
+            Image.open(BytesIO(photo)), 200, max_size=(696, sys.maxsize))),
+    ]
+    if 'pdf' in uploads:
+        cases.append(('convert/pdf', lambda: pdffile_to_image(uploads['pdf'], 300, width=696)))
+    return cases
+
+
+def environment():
+    versions = {}
+    for package in ('Pillow', 'brother_ql', 'qrcode', 'pdf2image'):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'packages': versions}
+
+
+def format_memory(value):
+    return '-' if value is None else '{:.1f}'.format(value / (1024 * 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--filter', default='', help='only run cases whose name contains this text')
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--model', default='QL-820NWB')
+    parser.add_argument('--save', metavar='FILE', help='write the results as JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed p50 slowdown against the baseline, 0.1 = 10%%')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['cases']
+
+    app = create_app()
+    results = {}
+    regressions = []
+    with app.app_context(), tempfile.TemporaryDirectory() as spool_dir:
+        cases = [(name, fn) for name, fn in create_cases(args.model, spool_dir) if args.filter in name]
+
+        print('{:<36} {:>10} {:>10} {:>10} {:>10} {:>8}'.format(
+            'case', 'ops/s', 'p50 [ms]', 'p99 [ms]', 'mem [MiB]', 'vs base'))
+        for name, fn in cases:
+            result = results[name] = run_case(fn, args.rounds)
+
+            change = ''
+            if baseline is not None and name in baseline:
+                ratio = result['p50'] / baseline[name]['p50'] - 1
+                change = '{:+.0%}'.format(ratio)
+                if ratio > args.tolerance:
+                    regressions.append(name)
+                    change += ' !'
+            print('{:<36} {:>10.1f} {:>10.2f} {:>10.2f} {:>10} {:>8}'.format(
+                name, result['ops_per_sec'], result['p50'] * 1000, result['p99'] * 1000,
+                format_memory(result['peak_memory']), change))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'environment': environment(),
+                'rounds': args.rounds,
+                'cases': results
+            }, f, indent=2)
+
+    if regressions:
+        print('\n{} case(s) slower than the baseline by more than {:.0%}:'.format(len(regressions), args.tolerance))
+        for name in regressions:
+            print('  ' + name)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
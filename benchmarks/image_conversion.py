@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for the conversion of uploaded images to black and white.
+
+Decodes and converts a generated multi-megapixel photo (JPEG and PNG) and,
+if poppler is installed, a multi-page PDF. Compares the former conversion
+(per pixel Python function at full resolution) with the lookup table, the
+early downscale to the printable width of a 62mm label and the dither modes.
+
+Usage: python -m benchmarks.image_conversion [--width 6000] [--height 4000] [--repeat 3]
+"""
+
+import argparse
+import shutil
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from app.utils import convert_image_to_bw, pdffile_to_image, DITHER_NONE, DITHER_FLOYD_STEINBERG, DITHER_ORDERED
+
+PRINTABLE_WIDTH = 696
+MAX_SIZE = (PRINTABLE_WIDTH, 1 << 30)
+
+
+class Upload:
+    """ Minimal stand-in for werkzeug's FileStorage """
+
+    def __init__(self, data):
+        self.data = data
+
+    def save(self, dst):
+        dst.write(self.data)
+
+
+def generate_photo(size, format):
+    r = Image.effect_mandelbrot(size, (-2.0, -1.2, 1.0, 1.2), 100)
+    g = Image.linear_gradient('L').resize(size)
+    b = Image.effect_noise(size, 40)
+    buffer = BytesIO()
+    Image.merge('RGB', (r, g, b)).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def former_conversion(image, threshold):
+    fn = lambda x : 255 if x > threshold else 0
+    return image.convert('L').point(fn, mode='1')
+
+
+def measure(fn, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+    return min(durations), result.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--width', type=int, default=6000)
+    parser.add_argument('--height', type=int, default=4000)
+    parser.add_argument('--pages', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    size = (args.width, args.height)
+
+    cases = []
+    for format in ('JPEG', 'PNG'):
+        data = generate_photo(size, format)
+        open_image = lambda data=data: Image.open(BytesIO(data))
+        cases += [
+            (format, 'former', lambda open_image=open_image: former_conversion(open_image(), 200)),
+            (format, 'lookup table', lambda open_image=open_image: convert_image_to_bw(open_image(), 200)),
+            (format, 'downscaled', lambda open_image=open_image: convert_image_to_bw(
+                open_image(), 200, DITHER_NONE, MAX_SIZE)),
+            (format, 'floyd-steinberg', lambda open_image=open_image: convert_image_to_bw(
+                open_image(), 200, DITHER_FLOYD_STEINBERG, MAX_SIZE)),
+            (format, 'ordered', lambda open_image=open_image: convert_image_to_bw(
+                open_image(), 200, DITHER_ORDERED, MAX_SIZE)),
+        ]
+
+    if shutil.which('pdftoppm'):
+        buffer = BytesIO()
+        page = Image.open(BytesIO(generate_photo((2480, 3508), 'JPEG')))
+        page.save(buffer, format='PDF', save_all=True, append_images=[page] * (args.pages - 1), resolution=300)
+        upload = Upload(buffer.getvalue())
+        cases += [
+            ('PDF', 'former', lambda: former_conversion(pdffile_to_image(upload, 300), 200)),
+            ('PDF', 'downscaled', lambda: convert_image_to_bw(
+                pdffile_to_image(upload, 300), 200, DITHER_NONE, MAX_SIZE)),
+        ]
+    else:
+        print('pdftoppm (poppler) not found, skipping the PDF cases\n')
+
+    print('{:>6} {:>16} {:>10} {:>14}'.format('input', 'conversion', 'time [s]', 'result'))
+    for format, name, fn in cases:
+        duration, result_size = measure(fn, args.repeat)
+        print('{:>6} {:>16} {:>10.3f} {:>14}'.format(format, name, duration, '{}x{}'.format(*result_size)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Load test of the preview endpoint served by gunicorn at different worker counts.
+
+Starts the production server (gunicorn.conf.py) for every worker count and
+sends preview requests from concurrent clients. Every request has a different
+text, so the previews are rendered and not served from the preview cache.
+
+Usage: python -m benchmarks.preview_load [--workers 1,2,4] [--threads 8]
+    [--clients 8] [--requests 200] [--port 8099]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+
+def preview_url(port, text):
+    query = urllib.parse.urlencode({'text': text, 'label_size': '62', 'font_size': 70})
+    return 'http://127.0.0.1:{}/labeldesigner/api/preview?{}'.format(port, query)
+
+
+def request_preview(url):
+    start = time.perf_counter()
+    with urllib.request.urlopen(url) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def start_server(port, workers, threads):
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '-b', '127.0.0.1:{}'.format(port), '-w', str(workers), '--threads', str(threads),
+         '--log-level', 'warning'],
+        cwd=basedir)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            request_preview(preview_url(port, 'warm up'))
+            return server
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--port', type=int, default=8099)
+    args = parser.parse_args()
+
+    print('{:>8} {:>8} {:>12} {:>10} {:>10}'.format('workers', 'threads', 'previews/s', 'p50 [ms]', 'p99 [ms]'))
+    for run, workers in enumerate(int(w) for w in args.workers.split(',')):
+        server = start_server(args.port, workers, args.threads)
+        try:
+            # every worker renders a few previews before the measurement
+            with ThreadPoolExecutor(args.clients) as clients:
+                list(clients.map(request_preview, [
+                    preview_url(args.port, 'warm up {}'.format(i)) for i in range(workers * 4)]))
+
+            urls = [preview_url(args.port, 'Run {} label {:05d}'.format(run, i)) for i in range(args.requests)]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(args.clients) as clients:
+                durations = sorted(clients.map(request_preview, urls))
+            elapsed = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait()
+
+        p99 = durations[min(len(durations) - 1, int(len(durations) * 0.99))]
+        print('{:>8} {:>8} {:>12.1f} {:>10.1f} {:>10.1f}'.format(
+            workers, args.threads, len(durations) / elapsed,
+            statistics.median(durations) * 1000, p99 * 1000))
+
+
+if __name__ == '__main__':
+    main()
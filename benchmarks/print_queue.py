@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for print jobs with many copies of the same label.
+
+Compares rendering and rasterizing every single copy (the former behaviour
+of PrinterQueue.process_queue) with rendering each distinct label once.
+The raster data is written to a file:// backend inside a temporary directory.
+
+Usage: python -m benchmarks.print_queue [--copies 1 10 100 200]
+"""
+
+import os
+import argparse
+import tempfile
+import time
+
+from app import create_app
+
+
+def timed_backend(backend_class, timings):
+    class TimedBackend(backend_class):
+        def write(self, data):
+            timings.setdefault('first_byte', time.perf_counter())
+            super().write(data)
+    return TimedBackend
+
+
+def process_queue_per_copy(queue):
+    """ The former implementation: render and rasterize every queue entry """
+    from app.labeldesigner.printer import rasterize_image
+
+    data = []
+    for queue_entry in queue._printQueue:
+        img = queue_entry['label'].generate()
+        data.append(rasterize_image(
+            queue.model, queue_entry['label'], img, queue_entry['label_size'], queue_entry['cut']))
+    queue._printQueue.clear()
+
+    queue.write(b''.join(data))
+
+
+def run(model, font_path, copies, per_copy):
+    from app.labeldesigner.label import SimpleLabel, LabelContent
+    from app.labeldesigner.printer import PrinterQueue
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = os.path.join(tmpdir, 'lp0')
+        open(output, 'wb').close()
+
+        queue = PrinterQueue(model, 'file://' + output)
+        timings = {}
+        queue.connection._backend_class = timed_backend(queue.connection._backend_class, timings)
+
+        label = SimpleLabel(
+            width=696,
+            label_content=LabelContent.TEXT_QRCODE,
+            label_margin=(24, 24, 24, 45),
+            text='ASSET-0000123',
+            text_align='center',
+            font_path=font_path)
+
+        start = time.perf_counter()
+        queue.add_label_to_queue(label, '62', copies)
+        if per_copy:
+            process_queue_per_copy(queue)
+        else:
+            queue.process_queue()
+        end = time.perf_counter()
+
+        return timings['first_byte'] - start, end - start, os.path.getsize(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--copies', type=int, nargs='+', default=[1, 10, 100, 200])
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        from app import FONTS
+        font_path = FONTS.fonts[
+            app.config['LABEL_DEFAULT_FONT_FAMILY']][app.config['LABEL_DEFAULT_FONT_STYLE']]
+
+        print('{:>8} {:>10} {:>14} {:>14} {:>12}'.format(
+            'copies', 'strategy', 'first byte [s]', 'total [s]', 'bytes'))
+        for copies in args.copies:
+            for strategy, per_copy in (('per copy', True), ('once', False)):
+                first_byte, total, size = run(
+                    app.config['PRINTER_MODEL'], font_path, copies, per_copy)
+                print('{:>8} {:>10} {:>14.3f} {:>14.3f} {:>12}'.format(
+                    copies, strategy, first_byte, total, size))
+
+
+if __name__ == '__main__':
+    main()
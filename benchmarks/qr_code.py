@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark for the QR code generation of labels.
+
+Compares the former path (qrcode's image factory drawing every module) with
+the cached module matrix scaled up to the box size, for short asset IDs and
+long URLs. "cold" clears the matrix cache before every code, "cached"
+generates codes which were already encoded.
+
+Usage: python -m benchmarks.qr_code [--codes 200] [--box-size 10]
+"""
+
+import argparse
+import time
+
+from qrcode import QRCode, constants
+
+from app import create_app
+
+
+def former_qr(data, box_size):
+    qr = QRCode(
+        version=1,
+        error_correction=constants.ERROR_CORRECT_L,
+        box_size=box_size,
+        border=0,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    return qr.make_image(fill_color='black', back_color="white")
+
+
+def measure(fn, payloads):
+    start = time.perf_counter()
+    for data in payloads:
+        fn(data)
+    return (time.perf_counter() - start) / len(payloads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--codes', type=int, default=200)
+    parser.add_argument('--box-size', type=int, default=10)
+    args = parser.parse_args()
+
+    create_app()
+    from app.labeldesigner.label import SimpleLabel, LabelContent, qr_matrix
+
+    payloads = {
+        'asset ID': ['A-{:06d}'.format(i) for i in range(args.codes)],
+        'long URL': ['https://inventory.example.com/assets/{:06d}?site=berlin&room=4.07&ref=label'.format(i)
+                     for i in range(args.codes)],
+    }
+
+    def new_qr(data):
+        return SimpleLabel(
+            label_content=LabelContent.QRCODE_ONLY,
+            text=data,
+            qr_size=args.box_size)._generate_qr()
+
+    def cold_qr(data):
+        qr_matrix.cache_clear()
+        return new_qr(data)
+
+    print('{:>10} {:>10} {:>14}'.format('payload', 'variant', 'per code [ms]'))
+    for name, data in payloads.items():
+        for variant, fn in (('former', lambda data: former_qr(data, args.box_size)),
+                            ('cold', cold_qr),
+                            ('cached', new_qr)):
+            if variant == 'cached':
+                measure(new_qr, data)
+            duration = measure(fn, data)
+            print('{:>10} {:>10} {:>14.3f}'.format(name, variant, duration * 1000))
+
+
+if __name__ == '__main__':
+    main()
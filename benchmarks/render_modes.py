@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Check that the render modes print exactly the same labels.
+
+Labels are composed as 1-bit images for black tapes and as palette images
+for black/red tapes (LABEL_RENDER_MODE = 'palette'), brother_ql reduces them
+to the printed colors like the RGB images of LABEL_RENDER_MODE = 'rgb'.
+Renders text, QR code, QR code + text and image labels for endless, die-cut,
+round and red label sizes in both orientations and print colors with both
+modes and compares the raster instructions sent to the printer. Also reports
+the render + rasterize time and the size of the rendered images.
+
+Exits with 1 if a label differs.
+
+Usage: python -m benchmarks.render_modes [--model QL-820NWB]
+"""
+
+import argparse
+import sys
+import time
+
+from app import create_app
+from app.uploads import Upload
+from benchmarks.image_conversion import generate_photo
+
+LABEL_SIZES = ('62', '62x29', '29x90', 'd24', 'd58', '62red')
+ORIENTATIONS = ('standard', 'rotated')
+PRINT_COLORS = ('black', 'red')
+
+TEXT = 'Render mode\nSKU 0012345'
+QR_DATA = 'https://inventory.example.com/assets/000123?site=berlin'
+
+
+def label_values(content, label_size, orientation, print_color):
+    values = {'label_size': label_size, 'orientation': orientation, 'print_color': print_color,
+              'font_size': 60, 'text': TEXT}
+    if content == 'qr':
+        values.update(print_type='qrcode', text=QR_DATA)
+    elif content == 'qr_text':
+        values.update(print_type='qrcode_text', text=QR_DATA + '\n' + TEXT)
+    elif content == 'image':
+        values['print_type'] = 'image'
+    return values
+
+
+def image_size(image):
+    return len(image.tobytes())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--model', default='QL-820NWB')
+    args = parser.parse_args()
+
+    app = create_app()
+    from app.labeldesigner.printer import rasterize_image
+    from app.labeldesigner.routes import create_label_from_values
+
+    photo = Upload('', 'photo.jpg', generate_photo((1200, 800), 'JPEG'))
+    totals = {'rgb': [0.0, 0], 'palette': [0.0, 0]}
+    differences = []
+    cases = 0
+
+    with app.app_context():
+        for content in ('text', 'qr', 'qr_text', 'image'):
+            upload = photo if content == 'image' else None
+            for label_size in LABEL_SIZES:
+                for orientation in ORIENTATIONS:
+                    for print_color in PRINT_COLORS:
+                        values = label_values(content, label_size, orientation, print_color)
+                        raster = {}
+                        for mode in ('rgb', 'palette'):
+                            app.config['LABEL_RENDER_MODE'] = mode
+                            start = time.perf_counter()
+                            label = create_label_from_values(values, upload)
+                            image = label.generate()
+                            raster[mode] = rasterize_image(args.model, label, image, label_size, True)
+                            totals[mode][0] += time.perf_counter() - start
+                            totals[mode][1] += image_size(image)
+                        cases += 1
+                        if raster['rgb'] != raster['palette']:
+                            differences.append('/'.join((content, label_size, orientation, print_color)))
+
+    print('{} labels compared'.format(cases))
+    print('{:>8} {:>14} {:>12}'.format('mode', 'render [s]', 'images [KB]'))
+    for mode, (duration, size) in totals.items():
+        print('{:>8} {:>14.2f} {:>12.0f}'.format(mode, duration, size / 1024))
+
+    if differences:
+        print('\n{} label(s) print differently in palette mode:'.format(len(differences)))
+        for name in differences:
+            print('  ' + name)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
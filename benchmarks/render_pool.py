@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for rendering the labels of a batch in a process pool.
+
+Renders and rasterizes a few hundred distinct labels with the given numbers
+of render processes. 1 renders all labels serially in the calling thread.
+The process pools are warmed up before measuring.
+
+Usage: python -m benchmarks.render_pool [--labels 300] [--processes 1 2 4]
+"""
+
+import os
+import argparse
+import time
+
+from app import create_app
+
+
+def run(app, labels, processes):
+    from app.jobs import create_render_executor
+    from app.labeldesigner.label import SimpleLabel, LabelContent
+    from app.labeldesigner.printer import PrinterQueue
+    from app import FONTS
+
+    font_path = FONTS.fonts[
+        app.config['LABEL_DEFAULT_FONT_FAMILY']][app.config['LABEL_DEFAULT_FONT_STYLE']]
+
+    config = dict(app.config, RENDER_PROCESSES=processes if processes > 1 else 0, RENDER_THREADS=1)
+    executor = create_render_executor(config)
+
+    queue = PrinterQueue(app.config['PRINTER_MODEL'], 'file:///dev/null')
+
+    def add_labels(count):
+        for i in range(count):
+            queue.add_label_to_queue(SimpleLabel(
+                width=696,
+                label_content=LabelContent.TEXT_QRCODE,
+                label_margin=(24, 24, 24, 45),
+                text='https://example.com/asset/{:06d}'.format(i),
+                text_align='center',
+                font_size=50,
+                font_path=font_path), '62', 1)
+
+    try:
+        if executor is not None:
+            add_labels(processes * 2)
+            queue.rasterize_queue(executor)
+
+        add_labels(labels)
+        start = time.perf_counter()
+        data = queue.rasterize_queue(executor)
+        duration = time.perf_counter() - start
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return duration, len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--labels', type=int, default=300)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()])
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        print('{:>10} {:>10} {:>12} {:>12}'.format('processes', 'time [s]', 'labels/s', 'bytes'))
+        for processes in args.processes:
+            duration, size = run(app, args.labels, processes)
+            print('{:>10} {:>10.3f} {:>12.1f} {:>12}'.format(
+                processes, duration, args.labels / duration, size))
+
+
+if __name__ == '__main__':
+    main()
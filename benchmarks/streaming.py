@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for long print jobs: buffered vs. streamed raster data.
+
+"buffered" rasterizes all labels of the job before writing the first byte,
+"streaming" writes every label as soon as it is rasterized. Each variant runs
+in its own process to measure the time to the first label, the total job
+time and the peak RSS. The raster data is written to a file:// backend
+inside a temporary directory.
+
+Usage: python -m benchmarks.streaming [--labels 500]
+"""
+
+import os
+import sys
+import json
+import argparse
+import resource
+import subprocess
+import tempfile
+import time
+
+from app import create_app
+
+
+def run(variant, labels):
+    app = create_app()
+
+    from app import FONTS
+    from app.labeldesigner.label import SimpleLabel, LabelContent
+    from app.labeldesigner.printer import PrinterQueue
+
+    font_path = FONTS.fonts[
+        app.config['LABEL_DEFAULT_FONT_FAMILY']][app.config['LABEL_DEFAULT_FONT_STYLE']]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = os.path.join(tmpdir, 'lp0')
+        open(output, 'wb').close()
+        queue = PrinterQueue(app.config['PRINTER_MODEL'], 'file://' + output)
+
+        timings = {}
+        backend_class = queue.connection._backend_class
+
+        class TimedBackend(backend_class):
+            def write(self, data):
+                timings.setdefault('first_label', time.perf_counter())
+                super().write(data)
+        queue.connection._backend_class = TimedBackend
+
+        for i in range(labels):
+            queue.add_label_to_queue(SimpleLabel(
+                width=696,
+                label_content=LabelContent.TEXT_QRCODE,
+                label_margin=(24, 24, 24, 45),
+                text='https://example.com/asset/{:06d}'.format(i),
+                text_align='center',
+                font_size=50,
+                font_path=font_path), '62', 1)
+
+        start = time.perf_counter()
+        if variant == 'streaming':
+            queue.write_stream(queue.iter_raster_queue())
+        else:
+            queue.write(queue.rasterize_queue())
+        end = time.perf_counter()
+
+        return {
+            'first_label': timings['first_label'] - start,
+            'total': end - start,
+            'bytes': os.path.getsize(output),
+            # kilobytes on Linux
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--labels', type=int, default=500)
+    parser.add_argument('--variant', choices=('buffered', 'streaming'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        print(json.dumps(run(args.variant, args.labels)))
+        return
+
+    print('{:>10} {:>16} {:>10} {:>14} {:>14}'.format(
+        'variant', 'first label [s]', 'total [s]', 'bytes', 'peak RSS [MB]'))
+    for variant in ('buffered', 'streaming'):
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.streaming', '--variant', variant,
+             '--labels', str(args.labels)],
+            stdout=subprocess.PIPE, check=True)
+        result = json.loads(output.stdout.decode('utf-8').strip().split('\n')[-1])
+        print('{:>10} {:>16.3f} {:>10.3f} {:>14} {:>14.1f}'.format(
+            variant, result['first_label'], result['total'], result['bytes'],
+            result['peak_rss'] / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
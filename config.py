@@ -14,9 +14,39 @@ class Config(object):
 
     SERVER_PORT = 8013
     SERVER_HOST = '0.0.0.0'
+    # Settings of the production server (gunicorn -c gunicorn.conf.py). Print jobs
+    # and caches are kept per worker process, more threads are preferred over more
+    # workers as the job state is only known to the worker which accepted a job.
+    SERVER_WORKERS = 1
+    SERVER_THREADS = 8
+    # Seconds a stopped or reloaded worker waits for its queued print jobs
+    SERVER_GRACEFUL_TIMEOUT = 60
 
     PRINTER_MODEL = 'QL-500'
     PRINTER_PRINTER = 'file:///dev/usb/lp1'
+    # Pool of printers, replaces PRINTER_MODEL/PRINTER_PRINTER if not empty. A list of
+    # dicts with 'device_specifier' and optionally 'name', 'model' and 'label_sizes'
+    # (the loaded tapes, any size if omitted), e.g.
+    # [{'name': 'desk 1', 'model': 'QL-820NWB', 'device_specifier': 'tcp://192.168.1.33:9100', 'label_sizes': ['62', '62red']}]
+    # Jobs are routed to the printers with the label sizes of the job.
+    PRINTERS = []
+    # Distribution of the jobs over printers with the same label size: 'least-busy'
+    # (fewest queued labels) or 'round-robin'
+    PRINTER_DISPATCH = 'least-busy'
+    # Seconds a printer which failed is skipped, its jobs are sent to another printer
+    # with the same label size as long as nothing reached the failed printer
+    PRINTER_RETRY_DELAY = 60
+    # Seconds the connection to the printer is kept open after a job (0 closes it right away)
+    PRINTER_IDLE_TIMEOUT = 60
+    # Number of finished print jobs whose state can still be queried
+    PRINT_JOB_HISTORY = 100
+    # Number of threads rendering the different labels of a print job in parallel
+    RENDER_THREADS = 4
+    # Number of processes rendering the labels of a print job, uses all cores for
+    # large batches. Takes precedence over RENDER_THREADS if larger than 0.
+    RENDER_PROCESSES = 0
+    # Number of labels rendered ahead of the printer while a job is being sent
+    RENDER_PREFETCH = 4
 
     LABEL_DEFAULT_ORIENTATION = 'standard'
     LABEL_DEFAULT_SIZE = '62'
@@ -25,5 +55,41 @@ class Config(object):
     LABEL_DEFAULT_LINE_SPACING = 100
     LABEL_DEFAULT_FONT_FAMILY = 'DejaVu Serif'
     LABEL_DEFAULT_FONT_STYLE = 'Book'
+    # Conversion of uploaded images to black and white: 'none', 'floyd-steinberg' or 'ordered'
+    IMAGE_DITHER = 'none'
+    # Labels are composed as 'palette' images with only the printed colors (1-bit for
+    # black tapes), 'rgb' composes full color images which brother_ql reduces
+    LABEL_RENDER_MODE = 'palette'
+    # Folder the label templates are stored in
+    LABEL_TEMPLATE_FOLDER = os.path.join(basedir, 'instance', 'templates')
+    # Folder the exported raster files (ready to send to the printer) are stored in
+    RASTER_SPOOL_FOLDER = os.path.join(basedir, 'instance', 'spool')
 
-    FONT_FOLDER = ''
\ No newline at end of file
+    FONT_FOLDER = ''
+    # Found fonts are stored in this file to speed up the startup, empty to disable
+    FONT_INDEX = os.path.join(basedir, 'instance', 'font_index.json')
+    # The font index is refreshed if one of these directories changes
+    FONT_DIRECTORIES = ['/usr/share/fonts', '/usr/local/share/fonts', '~/.fonts', '~/.local/share/fonts']
+    # Number of loaded font objects (path, size) kept in memory
+    FONT_POOL_SIZE = 32
+    # Font sizes of the default font which are loaded at startup, e.g. [50, 70, 100]
+    FONT_PRELOAD_SIZES = []
+
+    # Upper bound (in bytes) for the rendered previews kept in memory
+    PREVIEW_CACHE_SIZE = 16 * 1024 * 1024
+    # zlib compression level (0-9) of PNG previews, lower levels encode faster but
+    # the previews get larger
+    PREVIEW_COMPRESS_LEVEL = 6
+    # quality (0-100) of WebP previews
+    PREVIEW_WEBP_QUALITY = 80
+    # Send the durations of the rendering stages in a Server-Timing header, shown
+    # by the developer tools of browsers. Metrics are always available at /metrics
+    SERVER_TIMING = False
+    # Upper bound (in bytes) for the uploaded images kept in memory
+    UPLOAD_CACHE_SIZE = 64 * 1024 * 1024
+    # Upper bound (in bytes) for the black and white bitmaps converted from uploaded images
+    UPLOAD_BITMAP_CACHE_SIZE = 16 * 1024 * 1024
+    # Uploaded images are also stored in this folder to survive restarts, empty to disable
+    UPLOAD_FOLDER = os.path.join(basedir, 'instance', 'uploads')
+    # Upper bound (in bytes) for the uploads in UPLOAD_FOLDER, the oldest are removed first
+    UPLOAD_FOLDER_SIZE = 256 * 1024 * 1024
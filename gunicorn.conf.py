@@ -0,0 +1,57 @@
+"""
+Configuration of the production server, start it with:
+
+    gunicorn -c gunicorn.conf.py
+
+The settings are taken from config.py and 'instance/application.py'.
+"""
+
+import os
+import time
+import signal
+
+from flask import Config as FlaskConfig
+
+from config import Config, basedir
+
+settings = FlaskConfig(os.path.join(basedir, 'instance'))
+settings.from_object(Config)
+settings.from_pyfile('application.py', silent=True)
+
+wsgi_app = 'app:create_app(preload=True)'
+bind = '{}:{}'.format(settings['SERVER_HOST'], settings['SERVER_PORT'])
+workers = settings['SERVER_WORKERS']
+threads = settings['SERVER_THREADS']
+worker_class = 'gthread'
+# The master kills a stopped worker after graceful_timeout. The worker stops
+# waiting for its print jobs SERVER_GRACEFUL_TIMEOUT after it was stopped, the
+# margin is left to finish the label being sent and to exit.
+print_jobs_timeout = settings['SERVER_GRACEFUL_TIMEOUT']
+graceful_timeout = print_jobs_timeout + 10
+timeout = max(120, graceful_timeout + 10)
+
+# The app (fonts, font index, label geometries) is loaded once in the master
+# process. Workers started on a reload (SIGHUP) are forked from it and don't
+# have to scan and load the fonts again. The font index is refreshed before
+# the workers are forked, so they all see the same fonts.
+preload_app = True
+
+
+def post_worker_init(worker):
+    # Remember when the worker was stopped, it first finishes the running
+    # requests and only then waits for the print jobs in worker_exit
+    handle_exit = signal.getsignal(signal.SIGTERM)
+
+    def stop(signum, frame):
+        worker.stopped_at = time.monotonic()
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, stop)
+
+
+def worker_exit(server, worker):
+    # Print the jobs which were accepted by this worker before it goes away
+    from app import PRINT_JOBS
+    deadline = getattr(worker, 'stopped_at', time.monotonic()) + print_jobs_timeout
+    if not PRINT_JOBS.join(max(deadline - time.monotonic(), 0)):
+        server.log.warning('Worker %s exited with unfinished print jobs', worker.pid)
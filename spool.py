@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Pre-generates raster files (the instructions sent to the printer) and sends
+them to a printer later, without rendering the labels again.
+
+Usage:
+    ./spool.py render [--name NAME] [--compress] [--model MODEL] [--printer NAME]
+        [--batch FILE.csv|FILE.json] key=value...
+    ./spool.py list
+    ./spool.py replay NAME [--printer DEVICE] [--count N]
+    ./spool.py delete NAME
+
+The key=value pairs are the parameters of /labeldesigner/api/print, e.g.
+    ./spool.py render --name shelf text='Shelf 1' font_size=80 label_size=62
+"""
+
+import argparse
+import csv
+import json
+import sys
+import time
+
+from app import create_app
+
+
+def parse_values(pairs):
+    values = {}
+    for pair in pairs:
+        key, sep, value = pair.partition('=')
+        if not sep:
+            raise SystemExit('Expected key=value, got {}'.format(pair))
+        values[key] = value
+    return values
+
+
+def read_batch(path):
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if path.endswith('.json'):
+            return json.load(f)
+        return list(csv.DictReader(f))
+
+
+def render(args):
+    from app.labeldesigner.printer import queue_entries
+    from app.labeldesigner.routes import create_labels_from_values, export_raster_file
+
+    defaults = parse_values(args.values)
+    items = read_batch(args.batch) if args.batch else [{}]
+    entries = []
+    item_of_label = {}
+    for index, item in enumerate(items):
+        values = dict(defaults, **{key: value for key, value in item.items() if value not in (None, '')})
+        try:
+            for label in create_labels_from_values(values):
+                item_of_label[id(label)] = index
+                entries += queue_entries(
+                    label,
+                    values.get('label_size', '62'),
+                    int(values.get('print_count', 1)),
+                    int(values.get('cut_once', 0)) == 1)
+        except Exception as e:
+            print('item {}: {}'.format(index, e), file=sys.stderr)
+
+    options = {'name': args.name, 'model': args.model, 'printer': args.printer,
+               'compress': 1 if args.compress else 0}
+    start = time.perf_counter()
+    try:
+        metadata, errors = export_raster_file({key: value for key, value in options.items() if value}, entries)
+    except Exception as e:
+        raise SystemExit(str(e))
+    for label, e in errors:
+        print('item {}: {}'.format(item_of_label[id(label)], e), file=sys.stderr)
+    print('{name}: {labels} labels for {model}, {size} bytes in {duration:.2f}s'.format(
+        duration=time.perf_counter() - start, **metadata))
+
+
+def list_files(args):
+    from app import RASTER_SPOOL
+
+    for name in RASTER_SPOOL.names():
+        metadata = RASTER_SPOOL.get(name)
+        if metadata is None:
+            continue
+        print('{}\t{}\t{} labels\t{} bytes\t{}\t{}'.format(
+            name, metadata['model'], metadata['labels'], metadata['size'], ','.join(metadata['label_sizes']),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(metadata['created']))))
+
+
+def replay(args):
+    """ Sends the raster file directly, without the print workers of the server """
+    from app import RASTER_SPOOL
+    from app.labeldesigner.printer import get_printer_queue, PRINTER_POOL
+
+    metadata = RASTER_SPOOL.get(args.name)
+    if metadata is None:
+        raise SystemExit('Unknown raster file {}'.format(args.name))
+    if args.printer is None:
+        printer_queue = PRINTER_POOL.route(metadata['label_sizes'], model=metadata['model'])
+    else:
+        printer_queue = get_printer_queue(metadata['model'], args.printer)
+
+    start = time.perf_counter()
+    for _ in range(args.count):
+        printer_queue.write_stream(RASTER_SPOOL.iter_chunks(args.name))
+    printer_queue.connection.close()
+    print('{}: sent {} labels to {} in {:.2f}s'.format(
+        args.name, metadata['labels'] * args.count, printer_queue.device_specifier, time.perf_counter() - start))
+
+
+def delete(args):
+    from app import RASTER_SPOOL
+
+    if not RASTER_SPOOL.delete(args.name):
+        raise SystemExit('Unknown raster file {}'.format(args.name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('render', help='render labels into a raster file')
+    command.add_argument('--name', help='name of the raster file, generated if missing')
+    command.add_argument('--compress', action='store_true', help='compress the raster lines, if the model supports it')
+    command.add_argument('--model', help='printer model, by default the model of the printer the labels are routed to')
+    command.add_argument('--printer', help='name of the printer of the pool to render for')
+    command.add_argument('--batch', metavar='FILE', help='CSV or JSON file with one item of label parameters per row')
+    command.add_argument('values', nargs='*', metavar='key=value', help='label parameters, defaults of the batch items')
+    command.set_defaults(func=render)
+
+    command = commands.add_parser('list', help='list the raster files')
+    command.set_defaults(func=list_files)
+
+    command = commands.add_parser('replay', help='send a raster file to a printer')
+    command.add_argument('name')
+    command.add_argument('--printer', metavar='DEVICE', help='device specifier, by default a printer of the pool')
+    command.add_argument('--count', type=int, default=1, help='number of times the raster file is sent')
+    command.set_defaults(func=replay)
+
+    command = commands.add_parser('delete', help='delete a raster file')
+    command.add_argument('name')
+    command.set_defaults(func=delete)
+
+    args = parser.parse_args()
+    app = create_app()
+    with app.app_context():
+        args.func(args)
+
+
+if __name__ == '__main__':
+    main()